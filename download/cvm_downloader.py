@@ -0,0 +1,233 @@
+import requests
+from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from tqdm import tqdm
+from equity_research.cvm_columnar import columnar_copy, COLUMNAR_DIR
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+CVM_BASE_URL = "http://dados.cvm.gov.br/dados/CIA_ABERTA/DOC"
+# period -> (CVM document, file prefix)
+DATASETS = {"trimestral": ("ITR", "itr"), "anual": ("DFP", "dfp")}
+MANIFEST_FILE = "data/cvm_manifest.json"
+CHUNK_SIZE = 1024*1024 # 1 MB
+
+class RateLimiter():
+    '''
+    Spaces the start of consecutive requests, from any thread, by at least min_interval seconds.
+    '''
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class Manifest():
+    '''
+    JSON record of every downloaded zip ("{period}/{year}" -> url, size, etag, last_modified and extracted
+    files), used to skip the years already present. Saved after every update.
+    '''
+    def __init__(self, filename=MANIFEST_FILE):
+        self.filename = Path(filename)
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.filename.exists():
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+
+    def get(self, key: str) -> dict:
+        return self.entries.get(key)
+
+    def update(self, key: str, entry: dict):
+        with self._lock:
+            self.entries[key] = entry
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.filename.with_suffix(".tmp")
+            with open(tmp_file, "w") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(tmp_file, self.filename)
+
+def cvm_url(period: str, year: int, base_url=CVM_BASE_URL) -> str:
+    document, prefix = DATASETS[period]
+    return f"{base_url}/{document}/DADOS/{prefix}_cia_aberta_{year}.zip"
+
+def _remote_info(session, url: str, rate_limiter: RateLimiter, timeout: float) -> dict:
+    rate_limiter.wait()
+    r = session.head(url, allow_redirects=True, timeout=timeout)
+    if r.status_code != 200:
+        raise Exception(f"[_remote_info] HEAD {url} returned {r.status_code}.")
+    size = r.headers.get("Content-Length")
+    return {"size": int(size) if size is not None else None, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+def _is_extracted(period: str, extract_dir: Path, name: str, columnar_dir) -> bool:
+    # A CSV converted by cvm_columnar.ingest (and removed) is still there as parquet.
+    if (extract_dir / name).exists():
+        return True
+    columnar_file = columnar_copy(period, name, columnar_dir) if columnar_dir is not None else None
+    return columnar_file is not None and columnar_file.exists()
+
+def _is_up_to_date(entry: dict, remote: dict, period: str, extract_dir: Path, members_pattern, columnar_dir=COLUMNAR_DIR) -> bool:
+    if entry is None:
+        return False
+    if entry["members_pattern"] is not None and entry["members_pattern"] != members_pattern:
+        return False
+    if any(not _is_extracted(period, extract_dir, name, columnar_dir) for name in entry["extracted"]):
+        return False
+    if remote is None:
+        return True
+    if remote["etag"] is not None and entry.get("etag") is not None:
+        return remote["etag"] == entry["etag"]
+    return remote["size"] == entry["size"] and (remote["last_modified"] is None or remote["last_modified"] == entry.get("last_modified"))
+
+def _part_metadata(part: Path) -> dict:
+    meta_file = part.with_name(part.name + ".json")
+    if not part.exists() or not meta_file.exists():
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+def _write_part_metadata(part: Path, meta: dict):
+    with open(part.with_name(part.name + ".json"), "w") as f:
+        json.dump(meta, f)
+
+def _remove_part(part: Path):
+    for filename in (part, part.with_name(part.name + ".json")):
+        if filename.exists():
+            filename.unlink()
+
+def _total_size(r) -> int:
+    # "bytes 100-199/200" (206) or "bytes */200" (416) -> 200; Content-Length of a 200.
+    content_range = r.headers.get("Content-Range")
+    if content_range is not None:
+        total = content_range.rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+    size = r.headers.get("Content-Length")
+    return int(size) if size is not None and r.status_code == 200 else None
+
+def download_file(session, url: str, target: Path, rate_limiter: RateLimiter, timeout=60, chunk_size=CHUNK_SIZE, remote=None) -> Path:
+    '''
+    Streams url to target chunk by chunk through target.part, whose ETag/Last-Modified and total size are kept in
+    target.part.json. A .part left by an interrupted run is resumed with an HTTP Range request conditioned by
+    If-Range, so a remote file changed in the meantime is sent whole again and overwrites it. A .part without
+    validator or whose ETag/size differ from remote (_remote_info) is discarded. The file is renamed to target
+    only once its size matches the total announced by the server.
+    '''
+    part = target.with_name(target.name + ".part")
+    meta = _part_metadata(part)
+    if part.exists():
+        validator = meta.get("etag") or meta.get("last_modified") if meta is not None else None
+        changed = meta is not None and remote is not None and ((remote["etag"] is not None and meta.get("etag") is not None and remote["etag"] != meta["etag"]) or (remote["size"] is not None and meta.get("size") is not None and remote["size"] != meta["size"]))
+        if validator is None or changed:
+            logging.info(f"[download_file] Discarding stale {part}.")
+            _remove_part(part)
+            meta = None
+
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-", "If-Range": meta.get("etag") or meta["last_modified"]} if offset > 0 else {}
+
+    rate_limiter.wait()
+    with session.get(url, stream=True, headers=headers, timeout=timeout) as r:
+        total = _total_size(r)
+        if r.status_code == 416:
+            if total != offset:
+                # The .part is larger than the remote file: start over.
+                _remove_part(part)
+                return download_file(session, url, target, rate_limiter, timeout, chunk_size, remote)
+            logging.info(f"[download_file] {part} already complete.")
+        elif r.status_code in (200, 206):
+            if r.status_code == 200:
+                _write_part_metadata(part, {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"), "size": total})
+            mode = "ab" if r.status_code == 206 else "wb"
+            with open(part, mode) as f:
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+        else:
+            raise Exception(f"[download_file] Error downloading {url}. Error code: {r.status_code}")
+
+    size = part.stat().st_size
+    if total is not None and size != total:
+        if size > total:
+            _remove_part(part)
+        raise Exception(f"[download_file] {url} incomplete: {size} of {total} bytes.")
+    os.replace(part, target)
+    _remove_part(part)
+    return target
+
+def _extract(zip_file: Path, extract_dir: Path, members_pattern=None) -> list:
+    with ZipFile(zip_file) as z:
+        names = [name for name in z.namelist() if members_pattern is None or re.search(members_pattern, name)]
+        for name in names:
+            z.extract(name, extract_dir)
+    return names
+
+def download_year(period: str, year: int, manifest: Manifest, rate_limiter: RateLimiter, data_dir="data", base_url=CVM_BASE_URL, members_pattern=None, check_remote=True, keep_zip=False, timeout=60, columnar_dir=COLUMNAR_DIR) -> str:
+    '''
+    Downloads and extracts data/{period}/{year}/ unless the manifest says it is already there, as CSV or as its
+    parquet copy in columnar_dir (and, with check_remote, the remote ETag or size/Last-Modified didn't change).
+    Returns "skipped" or "downloaded".
+    '''
+    key = f"{period}/{year}"
+    url = cvm_url(period, year, base_url)
+    extract_dir = Path(data_dir, period, str(year))
+    with requests.Session() as session:
+        remote = _remote_info(session, url, rate_limiter, timeout) if check_remote else None
+        if _is_up_to_date(manifest.get(key), remote, period, extract_dir, members_pattern, columnar_dir):
+            return "skipped"
+
+        zip_dir = Path(data_dir, "zips", period)
+        zip_dir.mkdir(parents=True, exist_ok=True)
+        zip_file = download_file(session, url, zip_dir / url.rsplit("/", 1)[-1], rate_limiter, timeout, remote=remote)
+    extracted = _extract(zip_file, extract_dir, members_pattern)
+    entry = {
+        "url": url,
+        "size": zip_file.stat().st_size,
+        "etag": remote["etag"] if remote is not None else None,
+        "last_modified": remote["last_modified"] if remote is not None else None,
+        "members_pattern": members_pattern,
+        "extracted": extracted,
+    }
+    if not keep_zip:
+        zip_file.unlink()
+    manifest.update(key, entry)
+    return "downloaded"
+
+def download_cvm_data(period: str, year_start: int, year_end: int, data_dir="data", base_url=CVM_BASE_URL, n_workers=4, min_interval=1.0, statements=None, check_remote=True, keep_zip=False, manifest_file=MANIFEST_FILE, timeout=60, columnar_dir=COLUMNAR_DIR) -> dict:
+    '''
+    Downloads the CVM ITR ("trimestral") or DFP ("anual") zips of [year_start, year_end] with at most n_workers
+    concurrent downloads and min_interval seconds between requests, streaming each one to disk.
+    -> statements: e.g. ["DRE", "BPP"] extracts only those statements (con and ind); None extracts everything.
+    -> base_url: root of the CVM DOC tree, replaceable by a local mirror or test server;
+    -> columnar_dir: where cvm_columnar keeps the parquet copies, which count as extracted files.
+
+    A failed year doesn't stop the others. Returns {year: "downloaded" | "skipped" | "failed: <error>"}.
+    '''
+    manifest = Manifest(manifest_file)
+    rate_limiter = RateLimiter(min_interval)
+    members_pattern = None
+    if statements is not None:
+        members_pattern = rf"_({'|'.join(re.escape(statement) for statement in statements)})_(con|ind)_\d{{4}}\.csv$"
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(download_year, period, year, manifest, rate_limiter, data_dir, base_url, members_pattern, check_remote, keep_zip, timeout, columnar_dir): year for year in range(year_start, year_end + 1)}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            year = futures[future]
+            try:
+                results[year] = future.result()
+            except Exception as e:
+                error_msg = f"[download_cvm_data] Error downloading {period} data from CVM and year: {year}. {e}"
+                logging.error(error_msg)
+                results[year] = f"failed: {e}"
+    return dict(sorted(results.items()))
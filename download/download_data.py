@@ -1,52 +1,32 @@
-import requests
-from zipfile import ZipFile
-from io import BytesIO
-import time
-from tqdm import tqdm
 import logging
 from pathlib import Path
+from download.cvm_downloader import download_cvm_data, CVM_BASE_URL
 
 p = Path("log")
 p.mkdir(exist_ok=True)
 
 logging.basicConfig( filename="log/download_data.log", filemode='w+', level=logging.DEBUG, format= '%(asctime)s - %(levelname)s - %(message)s')
 
-def download_trimestral_data_from_cvm(year_start, year_end):
-    
-    years = list(range(year_start, year_end+1))
-    for year in tqdm(years):
-        
-        url = f'http://dados.cvm.gov.br/dados/CIA_ABERTA/DOC/ITR/DADOS/itr_cia_aberta_{year}.zip'
-        
-        r = requests.get(url, stream=True)
-        status = r.status_code
-        
-        if status == 200:
-            z = ZipFile(BytesIO(r.content))    
-            z.extractall(f"data/trimestral/{year}/")
-        else:
-            error_msg = f"[download_trimestral_data_from_cvm] Error downloading trimestral data from CVM and year: {year}. Error code: {status}"
-            logging.error(error_msg)
-            raise Exception(error_msg)
-        
-        time.sleep(5)
+def _raise_on_failures(func_name: str, results: dict):
+    failed = {year: status for year, status in results.items() if status.startswith("failed")}
+    if len(failed) > 0:
+        error_msg = f"[{func_name}] Error downloading data from CVM for years: {list(failed.keys())}. {list(failed.values())}"
+        logging.error(error_msg)
+        raise Exception(error_msg)
 
-def download_anual_data_from_cvm(year_start, year_end):
-    
-    years = list(range(year_start, year_end+1))
-    for year in tqdm(years):
-        
-        url = f'http://dados.cvm.gov.br/dados/CIA_ABERTA/DOC/DFP/DADOS/dfp_cia_aberta_{year}.zip'
-        
-        r = requests.get(url, stream=True)
-        status = r.status_code
-        
-        if status == 200:
-            z = ZipFile(BytesIO(r.content))    
-            z.extractall(f"data/anual/{year}/")
-        else:
-            error_msg = f"[download_anual_data_from_cvm] Error downloading anual data from CVM and year: {year}. Error code: {status}"
-            logging.error(error_msg)
-            raise Exception(error_msg)
-        
-        time.sleep(5)
\ No newline at end of file
+def download_trimestral_data_from_cvm(year_start, year_end, base_url=CVM_BASE_URL, **kwargs):
+    '''
+    ITR zips of [year_start, year_end] extracted to data/trimestral/{year}/. Years already downloaded are skipped.
+    See cvm_downloader.download_cvm_data for the options.
+    '''
+    results = download_cvm_data("trimestral", year_start, year_end, base_url=base_url, **kwargs)
+    _raise_on_failures("download_trimestral_data_from_cvm", results)
+    return results
+
+def download_anual_data_from_cvm(year_start, year_end, base_url=CVM_BASE_URL, **kwargs):
+    '''
+    DFP zips of [year_start, year_end] extracted to data/anual/{year}/. Years already downloaded are skipped.
+    '''
+    results = download_cvm_data("anual", year_start, year_end, base_url=base_url, **kwargs)
+    _raise_on_failures("download_anual_data_from_cvm", results)
+    return results
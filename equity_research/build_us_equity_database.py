@@ -1,18 +1,33 @@
 import pandas as pd
 import simfin as sf
 from simfin.names import *
-import yahooquery as yf
-from datetime import date, datetime
-from tqdm import tqdm
+from datetime import datetime
 import logging
 from pathlib import Path
+from equity_research.price_fetcher import PriceFetcher
+from equity_research import feature_engine
+from equity_research.feature_engine import FEATURES, build_features, fiscal_dates, delta_features, features_fingerprint, required_columns
+from equity_research.stage_cache import StageCache, select
+from equity_research.us_join import join_statements
+from equity_research.us_equities_store import EquitiesStore, EQUITIES_STORE_PATH, KEY_COLUMNS, key_hashes
 import inspect
 import pickle
 import numpy as np
-import time
+
+# Statement columns build_feature_engineering reads (the merge keys and prices are always kept).
+DB_COLUMNS = required_columns(FEATURES)
 
 class EquityResearchUS():
-    def __init__(self, prices_file=None, financial_statements_file=None, name_to_save_DB="equities_database.csv"):
+    def __init__(self, prices_file=None, financial_statements_file=None, name_to_save_DB="equities_database.csv", price_fetcher=None, incremental=False, store_path=EQUITIES_STORE_PATH, db_columns=DB_COLUMNS, n_partitions=1, stage_cache=None):
+        '''
+        -> incremental: get_equities_DB updates the parquet store in store_path with the new or restated filings and
+           the rows still waiting for prices, instead of rebuilding equities_database.csv from scratch;
+        -> db_columns: statement columns kept in the database, by default the ones FEATURES needs (features reading
+           other columns need them added here); None keeps every column;
+        -> n_partitions: ticker partitions joined one at a time (see us_join.join_statements);
+        -> stage_cache: True (or a StageCache) to keep the build_feature_engineering/build_dataset outputs of a
+           financial_statements_file, reloaded while the file and the feature definitions don't change.
+        '''
         sf.set_data_dir('data/us')
         sf.set_api_key(api_key='free')
         p = Path("log")
@@ -21,8 +36,14 @@ class EquityResearchUS():
         self.prices_file = prices_file
         self.financial_statements_file = financial_statements_file
         self.name_to_save_DB = name_to_save_DB
-
-    def _load_DB_prices(self, stock_list):
+        self.price_fetcher = price_fetcher if price_fetcher is not None else PriceFetcher()
+        self.incremental = incremental
+        self.db_columns = db_columns
+        self.n_partitions = n_partitions
+        self.stage_cache = StageCache() if stage_cache is True else (stage_cache or None)
+        self.store = EquitiesStore(store_path)
+
+    def _load_DB_prices(self, stock_list, save=True):
         func_name = inspect.currentframe().f_code.co_name
         
         if self.prices_file != None:
@@ -31,28 +52,16 @@ class EquityResearchUS():
 
         else:
             print("[INFO] Downloading Yahoo Prices data...")
-            list_df=[]
-            for ticker in tqdm(stock_list):
-                try:
-                    df_prices = yf.Ticker(ticker).history(period='max').reset_index()
-                    df_prices['price_next_quarter'] = df_prices['adjclose'].shift(-60)
-                    list_df.append(df_prices)
-                except:
-                    error_msg = f"[{func_name}] {ticker} not found. May be deslisted or it doesn't exist."
-                    logging.error(error_msg)
-                    pass
-
-                time.sleep(np.random.randint(low=2, high=5))
-
-            df_prices_fin = pd.concat(list_df)
-            df_prices_fin.to_csv("default_yahoo_prices.csv", index=False)
+            df_prices_fin = self.price_fetcher.fetch(stock_list)
+            if len(self.price_fetcher.failures) > 0:
+                logging.error(f"[{func_name}] {len(self.price_fetcher.failures)} tickers failed: {self.price_fetcher.failures}")
+            if save:
+                df_prices_fin.to_csv("default_yahoo_prices.csv", index=False)
 
         return df_prices_fin
 
 
-    def _build_us_equities_db(self):
-        print("[INFO] Loading financial statements...")
-
+    def _load_statements(self) -> tuple:
         df_income = sf.load(dataset='income', variant='quarterly', market='us')
         df_income = df_income.reset_index()
         
@@ -62,153 +71,125 @@ class EquityResearchUS():
         df_cashflow = sf.load_cashflow(variant='quarterly', market='us')
         df_cashflow = df_cashflow.reset_index()
 
-        print("[INFO] Loading stock prices...")
-
-        stock_list = df_income['Ticker'].unique().tolist()
-
-        df_prices_fin = self._load_DB_prices(stock_list)
-
-        df_prices_fin = df_prices_fin.rename({"date":"Publish Date", "symbol":"Ticker", 'adjclose':'price'}, axis=1)
-        df_prices_fin = df_prices_fin[['Publish Date', 'Ticker','price','price_next_quarter']]
-
         df_income.drop(['SimFinId', 'Currency', 'Restated Date'], axis=1, inplace=True)
         df_balance.drop(['SimFinId', 'Currency', 'Restated Date'], axis=1, inplace=True)
         df_cashflow.drop(['SimFinId', 'Currency', 'Restated Date'], axis=1, inplace=True)
+        return df_income, df_balance, df_cashflow
 
-        df_income['Report Date'] = df_income['Report Date'].astype(str)
-        df_income['Publish Date'] = df_income['Publish Date'].astype(str)
+    def _prepare_prices(self, df_prices_fin) -> pd.DataFrame():
+        df_prices_fin = df_prices_fin.rename({"date":"Publish Date", "symbol":"Ticker", 'adjclose':'price'}, axis=1)
+        df_prices_fin = df_prices_fin[['Publish Date', 'Ticker','price','price_next_quarter']]
+        df_prices_fin['Publish Date'] = pd.to_datetime(df_prices_fin['Publish Date'])
+        return df_prices_fin
+
+    def _build_us_equities_db(self):
+        print("[INFO] Loading financial statements...")
 
-        df_balance['Report Date'] = df_balance['Report Date'].astype(str)
-        df_balance['Publish Date'] = df_balance['Publish Date'].astype(str)
+        df_income, df_balance, df_cashflow = self._load_statements()
 
-        df_cashflow['Report Date'] = df_cashflow['Report Date'].astype(str)
-        df_cashflow['Publish Date'] = df_cashflow['Publish Date'].astype(str)
+        print("[INFO] Loading stock prices...")
 
-        print("[INFO] Merging Income, Balance and Cash Flow...")
+        stock_list = df_income['Ticker'].unique().tolist()
 
-        db_equities = pd.DataFrame()
-        db_equities = df_income.merge(df_balance, how='left', on=['Ticker', 'Report Date', 'Fiscal Year', 'Fiscal Period', 'Publish Date'])
-        db_equities = db_equities.merge(df_cashflow, how='left', on=['Ticker', 'Report Date', 'Fiscal Year', 'Fiscal Period', 'Publish Date'])
-        
-        db_equities['Publish Date'] = pd.to_datetime(db_equities['Publish Date'])
-        df_prices_fin['Publish Date'] = pd.to_datetime(df_prices_fin['Publish Date'])
+        df_prices_fin = self._prepare_prices(self._load_DB_prices(stock_list))
 
-        print("[INFO] Merging ASOF stock prices and financial statements...")
-        db_equities_with_prices = pd.merge_asof(db_equities.sort_values("Publish Date"), df_prices_fin.sort_values("Publish Date"), by=['Ticker'], on=['Publish Date'], allow_exact_matches=False, direction='forward')
+        print("[INFO] Merging Income, Balance and Cash Flow and ASOF stock prices...")
+        db_equities_with_prices = join_statements(df_income, df_balance, df_cashflow, df_prices_fin, self.db_columns, self.n_partitions)
 
         print("[INFO] Saving DB equities...")
         db_equities_with_prices.to_csv(f"data/us/{self.name_to_save_DB}", index=False)
 
         return db_equities_with_prices
 
+    def _update_us_equities_db(self) -> pd.DataFrame():
+        '''
+        Incremental _build_us_equities_db: only the (Ticker, Report Date, Publish Date) keys that are new, restated
+        (their row hash changed) or still missing prices are merged with their prices and appended to the store.
+        '''
+        print("[INFO] Loading financial statements...")
+        df_income, df_balance, df_cashflow = self._load_statements()
+
+        hashes = key_hashes([df_income, df_balance, df_cashflow])
+        to_update = pd.concat([self.store.stale_keys(hashes), self.store.incomplete_keys()], ignore_index=True).drop_duplicates(KEY_COLUMNS, keep='first')
+        print(f"[INFO] {to_update.shape[0]} new, restated or incomplete filings.")
+        if to_update.shape[0] == 0:
+            return self.store.read()
+
+        keys_to_update = pd.MultiIndex.from_frame(to_update[KEY_COLUMNS])
+        df_income, df_balance, df_cashflow = [df[pd.MultiIndex.from_frame(df[KEY_COLUMNS]).isin(keys_to_update)] for df in (df_income, df_balance, df_cashflow)]
+
+        print("[INFO] Loading stock prices...")
+        df_prices_fin = self._prepare_prices(self._load_DB_prices(df_income['Ticker'].unique().tolist(), save=False))
+
+        print("[INFO] Merging Income, Balance and Cash Flow and ASOF stock prices...")
+        db_equities_with_prices = join_statements(df_income, df_balance, df_cashflow, df_prices_fin, self.db_columns, self.n_partitions)
+
+        print("[INFO] Saving DB equities...")
+        self.store.append(db_equities_with_prices, to_update)
+        return self.store.read()
+
     def get_equities_DB(self):
         if self.financial_statements_file != None:
             df = pd.read_csv(f"data/us/{self.financial_statements_file}")
+        elif self.incremental:
+            df = self._update_us_equities_db()
         else:
             df = self._build_us_equities_db()
         return df
 
-    def _get_fiscal_date(self, row): 
-        if   row['Fiscal Period'] == 'Q1':
-            return date(row['Fiscal Year'], 3, 31)
-        elif row['Fiscal Period'] == 'Q2':
-            return date(row['Fiscal Year'], 6, 30)
-        elif row['Fiscal Period'] == 'Q3':
-            return date(row['Fiscal Year'], 9, 30)
-        elif row['Fiscal Period'] == 'Q4':
-            return date(row['Fiscal Year'], 12, 31)
-
-    def build_feature_engineering(self):
-
+    def _cached_stage(self, stage: str, compute, params: tuple, columns=None, fiscal_date_range=None) -> pd.DataFrame():
+        '''
+        Output of compute(), from the stage cache when its financial_statements_file, the pipeline code and params
+        didn't change. Only columns and the rows with fiscal_date in fiscal_date_range (start, end) are returned.
+        '''
+        if self.stage_cache is None or self.financial_statements_file is None:
+            return select(compute(), columns, fiscal_date_range)
+
+        code = [feature_engine, EquityResearchUS._build_feature_engineering, EquityResearchUS._build_dataset]
+        key = self.stage_cache.key(stage, [f"data/us/{self.financial_statements_file}"], code, params)
+        if not self.stage_cache.exists(key):
+            self.stage_cache.save(key, compute())
+        return self.stage_cache.load(key, columns, fiscal_date_range)
+
+    def build_feature_engineering(self, features=FEATURES, dtype=np.float64, inf_value=None, columns=None, fiscal_date_range=None):
+        '''
+        Ticker, fiscal_date, price and price_next_quarter plus every feature of features (see feature_engine),
+        evaluated in one vectorized pass. dtype=np.float32 for a lighter output, inf_value to replace +-inf.
+        columns and fiscal_date_range (start, end) select part of the output.
+        '''
+        params = (features_fingerprint(features), np.dtype(dtype).str, inf_value)
+        return self._cached_stage("features", lambda: self._build_feature_engineering(features, dtype, inf_value), params, columns, fiscal_date_range)
+
+    def _build_feature_engineering(self, features, dtype, inf_value):
         df = self.get_equities_DB()
-        df = df.fillna(0)
 
-        dataset = pd.DataFrame()
+        dataset = pd.DataFrame(index=df.index)
         dataset['Ticker'] = df['Ticker']
-        dataset['fiscal_date'] = df.apply(self._get_fiscal_date, axis=1)
-        dataset['price'] = df['price']
-        dataset['price_next_quarter'] = df['price_next_quarter']
+        dataset['fiscal_date'] = fiscal_dates(df['Fiscal Year'].fillna(0), df['Fiscal Period'].fillna(0))
+        dataset['price'] = df['price'].fillna(0)
+        dataset['price_next_quarter'] = df['price_next_quarter'].fillna(0)
 
         print("[INFO] Calculating primary features...")
 
-        # 1. Patrimonio Liquido / Book Value / Total Equity
-        dataset['total_equity'] = df['Total Equity']
-        # 2. Dividend Yield
-        dataset['dividend_yield'] = df['Dividends Paid'] / (df['Shares (Diluted)_x'] * df['price'])
-        # 3. Earning per Shares
-        dataset['earning_per_shares'] = df['Net Income'] / df['Shares (Diluted)_x']
-        # 4. Net Revenue / Gross Profit
-        dataset['gross_profit'] = df['Gross Profit']
-        # 5. Price to Earnings Ratio
-        dataset['price_to_earnings_ratio'] = df['price'] / ( df['Net Income'] / df['Shares (Diluted)_x'] )
-        # 6. Price to Book Ratio
-        dataset['price_to_book_ratio'] = df['price'] / df['Total Equity']
-        # 7. Price to Sales Ratio
-        dataset['price_to_sales_ratio'] = ( df['Shares (Diluted)_x'] * df['price'] ) / df['Revenue']
-        # 8. Dividends per Share
-        dataset['dividend_per_shares'] = df['Dividends Paid'] / df['Shares (Diluted)_x']
-        # 9. Current Ratio
-        dataset['current_ratio'] = df['Total Current Assets'] / df['Total Current Liabilities']
-        # 10. Quick Ratio
-        dataset['quick_ratio'] = ( df['Total Current Assets'] - df['Inventories'] ) / df['Total Current Liabilities']
-        # 11. Debt Equity Ratio
-        dataset['debt_equity_ratio'] = df['Total Current Liabilities'] / df['Total Equity']
-        # 12. Profit Margin
-        dataset['profit_margin'] = df['Net Income'] / df['Revenue']
-        # 13. Operating Margin
-        dataset['operating_margin'] = df['Operating Income (Loss)'] / df['Revenue']
-        # 14. Asset Turnover
-        dataset['asset_turnover'] = df['Revenue'] / df['Total Assets']
-        # 15. Return on Asset
-        dataset['return_on_asset'] = df['Net Income'] / df['Total Assets']
-        # 16. Return on Equity
-        dataset['ROE'] = df['Net Income'] / df['Total Equity']
-        # 17. Price to Cash Flow Ratio
-        # TODO
-        # 18. Cash Ratio
-        dataset['CR'] = df['Cash, Cash Equivalents & Short Term Investments'] / df['Total Current Liabilities']
-        # 19. Enterprise Multiple
-        EV = (df['Shares (Diluted)_x'] * df['price']) + df['Total Liabilities'] - df['Cash, Cash Equivalents & Short Term Investments']
-        EBITDA = df['Gross Profit'] + df['Operating Expenses']
-        dataset['EM'] = EV/EBITDA
-        # 20. Long Term Debt to Total Assets
-        dataset['long_term_debt/total_assets'] = df['Long Term Debt'] / df['Total Assets']
-        # 21. Working Capital Ratio
-        dataset['WCR'] = df['Total Current Assets'] / df['Total Current Liabilities']
+        dataset = pd.concat([dataset, build_features(df, features, dtype, inf_value)], axis=1)
 
         return dataset
 
-    def build_dataset(self):
+    def build_dataset(self, n_workers=None, columns=None, fiscal_date_range=None):
+        '''
+        Delta features (see feature_engine.delta_features) and forward return of every ticker, without rows
+        missing values and with +-inf replaced by 0. n_workers computes the ticker partitions in parallel processes.
+        columns and fiscal_date_range (start, end) select part of the output. Outliers can then be removed with
+        feature_engine.filter_outliers.
+        '''
+        return self._cached_stage("dataset", lambda: self._build_dataset(n_workers), (), columns, fiscal_date_range)
 
+    def _build_dataset(self, n_workers=None):
         dataset = self.build_feature_engineering()
 
-        tickers = dataset['Ticker'].unique().tolist()
-
-        list_df = []
-
         print("[INFO] Calculating delta features...")
 
-        for ticker in tqdm(tickers):
-            df_filt = dataset[dataset['Ticker'] == ticker]
-            df_filt = df_filt.sort_values(by='fiscal_date')
-            
-            _returns = ((df_filt['price_next_quarter'] - df_filt['price'])/(df_filt['price'])).copy()
-            _ticker = df_filt['Ticker'].copy()
-            _fiscal_date = df_filt['fiscal_date'].copy()
-            
-            df_filt.drop(['Ticker', 'fiscal_date', 'price', 'price_next_quarter'], axis=1, inplace=True)
-            
-            df_filt = df_filt.pct_change()
-            df_filt = df_filt[1:]
-            df_filt = df_filt.fillna(0)
-            
-            df_filt['return'] = _returns
-            df_filt['Ticker'] = _ticker
-            df_filt['fiscal_date'] = _fiscal_date
-            
-            list_df.append(df_filt)
-
-        dataset = pd.concat(list_df)
+        dataset = delta_features(dataset, n_workers)
 
         dataset = dataset.dropna()
 
@@ -216,4 +197,3 @@ class EquityResearchUS():
         dataset = dataset.replace(-np.inf, 0)
 
         return dataset
-
@@ -0,0 +1,119 @@
+import pandas as pd
+import argparse
+import logging
+import re
+import unidecode
+from pathlib import Path
+from tqdm import tqdm
+
+'''
+Columnar copy of the extracted CVM ITR/DFP files, as parquet partitioned by period, statement, con/ind and year:
+    data/columnar/{period}/statement={statement}/consolidation={con|ind}/year={year}/part-0.parquet
+
+e.g.:
+python -m equity_research.cvm_columnar 2011 2021
+'''
+
+COLUMNAR_DIR = "data/columnar"
+PERIODS = {"trimestral": "itr", "anual": "dfp"}
+CATEGORICAL_COLUMNS = ['CNPJ_CIA', 'DENOM_CIA', 'GRUPO_DFP', 'MOEDA', 'ESCALA_MOEDA', 'ORDEM_EXERC', 'CD_CONTA', 'DS_CONTA', 'ST_CONTA_FIXA', 'COLUNA_DF', 'DS_CONTA_NORM']
+DATE_COLUMNS = ['DT_REFER', 'DT_INI_EXERC', 'DT_FIM_EXERC']
+
+def transform_string(x: str) -> str:
+    x = unidecode.unidecode(x)
+    x = x.replace(" de "," ").replace(" da "," ").replace(" das ", " ").replace(" dos ", " ").replace(" do ", " ").replace(" ou ", "/")
+    x = x.lower()
+    return x
+
+def normalize_account_description(ds_conta: pd.Series()) -> pd.Series():
+    '''
+    transform_string without " liquido ", computed once per distinct account description.
+    '''
+    descriptions = ds_conta.dropna().unique()
+    normalized = {x: transform_string(x).replace(" liquido ", " ") for x in descriptions}
+    return ds_conta.map(normalized)
+
+def columnar_path(period: str, statement: str, consolidation: str, year: int, columnar_dir=COLUMNAR_DIR) -> Path:
+    return Path(columnar_dir) / period / f"statement={statement}" / f"consolidation={consolidation}" / f"year={year}" / "part-0.parquet"
+
+def read_csv_statement(filename: str) -> pd.DataFrame():
+    return pd.read_csv(filename, encoding='iso-8859-1', sep=';')
+
+def to_columnar_frame(df: pd.DataFrame()) -> pd.DataFrame():
+    '''
+    Compact dtypes: categoricals for the repeated text columns, datetimes for the dates, float for the values and
+    the normalized DS_CONTA precomputed.
+    '''
+    df = df.copy()
+    if 'DS_CONTA' in df.columns:
+        df['DS_CONTA_NORM'] = normalize_account_description(df['DS_CONTA'])
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column], format='%Y-%m-%d')
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    if 'VL_CONTA' in df.columns:
+        df['VL_CONTA'] = df['VL_CONTA'].astype('float64')
+    return df
+
+def concat_statements(frames: list) -> pd.DataFrame():
+    '''
+    pd.concat that keeps the categorical columns categorical when the frames have different categories.
+    '''
+    df = pd.concat(frames)
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns and all(isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            df[column] = df[column].astype('category')
+    return df
+
+def columnar_copy(period: str, csv_name: str, columnar_dir=COLUMNAR_DIR) -> Path:
+    '''
+    columnar_path of an extracted {itr|dfp}_cia_aberta_{statement}_{con|ind}_{year}.csv, None for other files.
+    '''
+    match = re.fullmatch(rf"{PERIODS[period]}_cia_aberta_(?P<statement>.+)_(?P<consolidation>con|ind)_(?P<year>\d{{4}})\.csv", Path(csv_name).name)
+    if match is None:
+        return None
+    return columnar_path(period, match['statement'], match['consolidation'], int(match['year']), columnar_dir)
+
+def ingest_year(period: str, year: int, data_dir="data", columnar_dir=COLUMNAR_DIR, overwrite=False, remove_csv=True) -> list:
+    '''
+    Converts every {itr|dfp}_cia_aberta_{statement}_{con|ind}_{year}.csv of data/{period}/{year}/ to parquet.
+    Files whose parquet copy is newer than the CSV are skipped unless overwrite is set. With remove_csv, each CSV
+    is deleted once its parquet copy is written and read back with the same rows and columns.
+    '''
+    written = []
+    for filename in sorted(Path(data_dir, period, str(year)).glob("*.csv")):
+        target = columnar_copy(period, filename.name, columnar_dir)
+        if target is None or f"year={year}" not in target.parts:
+            continue
+        if not overwrite and target.exists() and target.stat().st_mtime >= filename.stat().st_mtime:
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        df = to_columnar_frame(read_csv_statement(filename))
+        df.to_parquet(target, index=False, compression='zstd')
+        logging.info(f"[ingest_year] {filename} -> {target}")
+        written.append(target)
+        if remove_csv:
+            stored = pd.read_parquet(target)
+            if stored.shape != df.shape or stored.columns.tolist() != df.columns.tolist():
+                raise Exception(f"[ingest_year] {target} doesn't match {filename}, CSV kept.")
+            filename.unlink()
+    return written
+
+def ingest(year_start: int, year_end: int, periods=("trimestral", "anual"), data_dir="data", columnar_dir=COLUMNAR_DIR, overwrite=False, remove_csv=True) -> list:
+    written = []
+    for period in periods:
+        for year in tqdm(range(year_start, year_end + 1)):
+            written += ingest_year(period, year, data_dir, columnar_dir, overwrite, remove_csv)
+    return written
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converts the extracted CVM CSV files to a partitioned parquet dataset.")
+    parser.add_argument("year_start", type=int)
+    parser.add_argument("year_end", type=int)
+    parser.add_argument("--periods", nargs="+", default=list(PERIODS.keys()))
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--keep-csv", action="store_true", help="Keep the CSV files after the conversion.")
+    args = parser.parse_args()
+    ingest(args.year_start, args.year_end, args.periods, overwrite=args.overwrite, remove_csv=not args.keep_csv)
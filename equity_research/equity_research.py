@@ -2,31 +2,61 @@ import pandas as pd
 from datetime import datetime, date
 import logging
 from pathlib import Path
-import unidecode
 import warnings
-import inspect
+from collections import namedtuple
+from equity_research.statement_cache import statement_cache
+from equity_research.instrumentation import Instrumentation, AuditSink
+from equity_research.ticker_mapping import TickerCnpjMap
+from equity_research.statement_index import StatementIndex, resolve_latest_dre, resolve_latest_bpp
+from equity_research.statement_scan import scan_statement_file, DEFAULT_CHUNK_ROWS
+from equity_research.cvm_columnar import COLUMNAR_DIR, columnar_path, transform_string, normalize_account_description, concat_statements
+
+# How each fundamental is read: the statement, the column/value identifying the account and whether a missing
+# non-zero value falls back to 0.0 with a warning (the _filt_DRE_df behaviour) instead of being an error.
+FundamentalField = namedtuple("FundamentalField", ["statement", "column", "value", "zero_fallback"])
+
+FUNDAMENTAL_FIELDS = {
+    "gross_revenue": FundamentalField("DRE", "CD_CONTA", "3.01", True),
+    "resultado_bruto": FundamentalField("DRE", "CD_CONTA", "3.03", True),
+    "net_profit": FundamentalField("DRE", "DS_CONTA_NORM", "lucro/prejuizo periodo", True),
+    "book_value": FundamentalField("BPP", "DS_CONTA", "Patrimônio Líquido", False),
+}
 
 class EquityResearch():
 
-    def __init__(self, ibov=True):
+    def __init__(self, ibov=True, cache=None, columnar_dir=COLUMNAR_DIR, log_level=logging.WARNING, audit=False, instrumentation=True):
+        '''
+        -> log_level: level of log/equity_research.log;
+        -> audit: True (or an AuditSink) to keep the get_DRE dumps, written in batches to log/audit/*.parquet;
+        -> instrumentation: records per stage timings and row counts, see instrumentation_summary().
+        '''
         p = Path("log")
         p.mkdir(exist_ok=True)
-        logging.basicConfig( filename="log/equity_research.log", filemode='w+', level=logging.DEBUG, format= '%(asctime)s - %(levelname)s - %(message)s')
+        logging.basicConfig( filename="log/equity_research.log", filemode='w+', level=log_level, format= '%(asctime)s - %(levelname)s - %(message)s')
 
         if ibov:
             sheet_name="IBOVCNPJ"
         else:
             sheet_name="ALLCNPJ"
 
-        self._from_ticker_to_cnpj = pd.read_excel("input/from_ticker_to_cnpj.xlsx", sheet_name=sheet_name)
+        self._ticker_map = TickerCnpjMap(sheet_name)
+        self.cache = cache if cache is not None else statement_cache
+        self.columnar_dir = columnar_dir
+        self.audit_sink = AuditSink() if audit is True else (audit or None)
+        self.instrumentation = Instrumentation(enabled=instrumentation)
 
     def _transform_string(self, x: str) -> str:
-        x = unidecode.unidecode(x)
-        x = x.replace(" de "," ").replace(" da "," ").replace(" das ", " ").replace(" dos ", " ").replace(" do ", " ").replace(" ou ", "/")
-        x = x.lower()
-        return x
+        return transform_string(x)
+
+    def _normalize_DS_CONTA(self, ds_conta: pd.Series()) -> pd.Series():
+        return normalize_account_description(ds_conta)
 
     def _filt_DRE_df(self, df, ticker, date_arg, column_based, value_to_filt, func_name, name_value):
+        with self.instrumentation.stage("account_resolution") as stage:
+            stage.rows = df.shape[0]
+            return self._filt_DRE_values(df, ticker, date_arg, column_based, value_to_filt, func_name, name_value)
+
+    def _filt_DRE_values(self, df, ticker, date_arg, column_based, value_to_filt, func_name, name_value):
         if value_to_filt in df[column_based].tolist():
             df = df[df[column_based] == value_to_filt]
         else:
@@ -44,41 +74,115 @@ class EquityResearch():
             warnings.warn(warning_msg)
         return value_to_return   
 
+    def _statement_filename(self, statement: str, consolidation: str, year: int) -> str:
+        '''
+        The columnar copy (see equity_research.cvm_columnar) when it was ingested, the extracted CSV otherwise.
+        '''
+        columnar_file = columnar_path("trimestral", statement, consolidation, year, self.columnar_dir)
+        if columnar_file.exists():
+            return str(columnar_file)
+        return f"data/trimestral/{year}/itr_cia_aberta_{statement}_{consolidation}_{year}.csv"
+
+    def _read_statement(self, statement: str, consolidation: str, year: int) -> pd.DataFrame():
+        filename = self._statement_filename(statement, consolidation, year)
+        with self.instrumentation.stage("file_load") as stage:
+            if filename.endswith(".parquet"):
+                df = pd.read_parquet(filename)
+            else:
+                df = pd.read_csv(filename, encoding='iso-8859-1', sep=';')
+            stage.rows = df.shape[0]
+        return df
+
+    def _load_latest_DRE(self, year: int) -> StatementIndex:
+        '''
+        Consolidated + individual DRE of the year, already reduced to the rows get_DRE reports for each
+        company-quarter and indexed by (CNPJ_CIA, DT_REFER). Built once per year and kept in the statement cache.
+        '''
+        filenames = [self._statement_filename("DRE", consolidation, year) for consolidation in ("con", "ind")]
+        def loader():
+            df = concat_statements([self._read_statement("DRE", "con", year), self._read_statement("DRE", "ind", year)])
+            with self.instrumentation.stage("resolution") as stage:
+                df = resolve_latest_dre(df).copy()
+                if 'DS_CONTA_NORM' not in df.columns:
+                    df['DS_CONTA_NORM'] = self._normalize_DS_CONTA(df['DS_CONTA'])
+                index = StatementIndex(df)
+                stage.rows = df.shape[0]
+            return index
+        return self.cache.get(("DRE", "con+ind", year, "latest"), filenames, loader)
+
+    def _load_latest_BPP(self, year: int) -> StatementIndex:
+        filename = self._statement_filename("BPP", "ind", year)
+        def loader():
+            df = self._read_statement("BPP", "ind", year)
+            with self.instrumentation.stage("resolution") as stage:
+                index = StatementIndex(resolve_latest_bpp(df))
+                stage.rows = index.table.shape[0]
+            return index
+        return self.cache.get(("BPP", "ind", year, "latest"), [filename], loader)
+
+    def iter_statements(self, statement: str, years: list, consolidations=("con", "ind"), tickers=None, cnpjs=None, dt_refer_start=None, dt_refer_end=None, accounts=None, account_column='CD_CONTA', columns=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        '''
+        Streams the matching rows of the statement files of every year and con/ind, one chunk at a time, without
+        going through the statement cache (see statement_scan.scan_statement_file). tickers are added to cnpjs.
+        Missing years are logged and skipped.
+        '''
+        if tickers is not None:
+            cnpjs = set(cnpjs if cnpjs is not None else []) | {self.get_cnpj_from_ticker(ticker) for ticker in tickers}
+        for year in years:
+            for consolidation in consolidations:
+                filename = self._statement_filename(statement, consolidation, year)
+                if not Path(filename).exists():
+                    logging.warning(f"[iter_statements] {filename} not found. Skipping.")
+                    continue
+                yield from scan_statement_file(filename, columns, cnpjs, dt_refer_start, dt_refer_end, accounts, account_column, chunk_rows)
+
+    def scan_statements(self, statement: str, years: list, **filters) -> pd.DataFrame():
+        '''
+        iter_statements materialized: only the matching rows and columns are kept in memory, whatever the number
+        of years. e.g. gross revenue panel of two companies over 2011-2021:
+            er.scan_statements("DRE", range(2011, 2022), tickers=["ABEV3", "TIET11"], accounts=["3.01"])
+        Raw rows: apply statement_index.resolve_latest_dre/resolve_latest_bpp to keep the rows get_DRE reports.
+        '''
+        chunks = list(self.iter_statements(statement, years, **filters))
+        if len(chunks) == 0:
+            return pd.DataFrame(columns=filters.get('columns'))
+        return concat_statements(chunks).reset_index(drop=True)
+
+    @property
+    def _from_ticker_to_cnpj(self) -> pd.DataFrame():
+        return self._ticker_map.frame
+
     def get_all_tickers(self) -> list:
-        return self._from_ticker_to_cnpj['security'].unique().tolist()
+        return self._ticker_map.tickers
 
     def get_cnpj_from_ticker(self, ticker: str) -> str:
-        cnpj = self._from_ticker_to_cnpj[self._from_ticker_to_cnpj['security'] == ticker]
-        if cnpj.shape[0] > 0:
-            cnpj = cnpj['CNPJ'].iloc[0]
-        else:
+        cnpj = self._ticker_map.ticker_to_cnpj.get(ticker)
+        if cnpj is None:
             error_msg = f"[get_cnpj_from_ticker] CPNJ for {ticker} not found. Verify the if the ticker passed as an argument is correct."
             logging.error(error_msg)
             raise Exception(error_msg)
         return cnpj        
 
-    def get_DRE(self, ticker: str, date_arg: date, log_enabled=True) -> pd.DataFrame():
-        this_function_name = inspect.currentframe().f_code.co_name
+    def get_tickers_from_cnpj(self, cnpj: str) -> list:
+        tickers = self._ticker_map.cnpj_to_tickers.get(cnpj)
+        if tickers is None:
+            error_msg = f"[get_tickers_from_cnpj] Tickers for {cnpj} not found."
+            logging.error(error_msg)
+            raise Exception(error_msg)
+        return tickers
+
+    def _get_DRE_rows(self, ticker: str, date_arg: date) -> pd.DataFrame():
+        this_function_name = "get_DRE"
         cnpj = self.get_cnpj_from_ticker(ticker)
         try:
-            filename=f"data/trimestral/{date_arg.year}/itr_cia_aberta_DRE_con_{date_arg.year}.csv"
-            df = pd.read_csv(filename, encoding='iso-8859-1', sep=';') 
-            filename=f"data/trimestral/{date_arg.year}/itr_cia_aberta_DRE_ind_{date_arg.year}.csv"
-            df_ind = pd.read_csv(filename, encoding='iso-8859-1', sep=';')
+            dre = self._load_latest_DRE(date_arg.year)
         except:
             raise Exception(f"[{this_function_name}] Data from year {date_arg.year} not found. Check if you have download the cvm data from {date_arg.year}.")
-        
-        df = df.append(df_ind)
-
-        if cnpj in df['CNPJ_CIA'].tolist():
-            df = df[df['CNPJ_CIA'] == cnpj]
-            df = df[df['DT_REFER'] == str(date_arg)]
-            df = df[df['VERSAO'] == df['VERSAO'].max()]
-            df = df[df['ORDEM_EXERC'] == 'ÚLTIMO']
-            df = df[df['DT_INI_EXERC'] == df['DT_INI_EXERC'].min()]
-            df = df[df['DT_FIM_EXERC'] == df['DT_FIM_EXERC'].max()]
-            if log_enabled:
-                df.to_excel("log/"+ticker+"_dre.xlsx")
+
+        if dre.has_cnpj(cnpj):
+            with self.instrumentation.stage("lookup") as stage:
+                df = dre.lookup(cnpj, str(date_arg)).copy()
+                stage.rows = df.shape[0]
         else:
             error_msg = f"[{this_function_name}] cnpj for {ticker} in {date_arg} not found."
             logging.error(error_msg)
@@ -86,38 +190,42 @@ class EquityResearch():
         
         return df
 
+    def get_DRE(self, ticker: str, date_arg: date, log_enabled=True) -> pd.DataFrame():
+        df = self._get_DRE_rows(ticker, date_arg).drop(columns=['DS_CONTA_NORM'])
+        if log_enabled and self.audit_sink is not None:
+            self.audit_sink.add(f"{ticker}_dre", df)
+        return df
+
     def get_DMPL(self, ticker, date_arg, log_enabled=True) -> pd.DataFrame():
         pass
 
     def get_gross_revenue(self, ticker: str, date_arg: date) -> float:
-        this_function_name = inspect.currentframe().f_code.co_name
-        df = self.get_DRE(ticker, date_arg, log_enabled=False)
+        this_function_name = "get_gross_revenue"
+        df = self._get_DRE_rows(ticker, date_arg)
         gross_revenue = self._filt_DRE_df(df, ticker, date_arg, "CD_CONTA", "3.01", this_function_name, "gross_revenue")
         return gross_revenue   
 
     def get_resultado_bruto(self, ticker: str, date_arg: date) -> float:
-        this_function_name = inspect.currentframe().f_code.co_name
-        df = self.get_DRE(ticker, date_arg, log_enabled=False)
+        this_function_name = "get_resultado_bruto"
+        df = self._get_DRE_rows(ticker, date_arg)
         resultado_bruto = self._filt_DRE_df(df, ticker, date_arg, "CD_CONTA", "3.03", this_function_name, "resultado_bruto")
         return resultado_bruto
 
     def get_net_profit(self, ticker: str, date_arg: date) -> float:
-        this_function_name = inspect.currentframe().f_code.co_name
-        df = self.get_DRE(ticker, date_arg, log_enabled=False)
-        df['DS_CONTA'] = df['DS_CONTA'].apply(self._transform_string)
-        df['DS_CONTA'] = df['DS_CONTA'].apply(lambda x: x.replace(" liquido ", " "))
-        net_profit = self._filt_DRE_df(df, ticker, date_arg, "DS_CONTA", "lucro/prejuizo periodo", this_function_name, "net profit")
+        this_function_name = "get_net_profit"
+        df = self._get_DRE_rows(ticker, date_arg)
+        net_profit = self._filt_DRE_df(df, ticker, date_arg, "DS_CONTA_NORM", "lucro/prejuizo periodo", this_function_name, "net profit")
         return net_profit
 
     def get_book_value(self, ticker: str, date_arg: date) -> float:
-        this_function_name = inspect.currentframe().f_code.co_name
+        this_function_name = "get_book_value"
         cnpj = self.get_cnpj_from_ticker(ticker)
-        filename=f"data/trimestral/{date_arg.year}/itr_cia_aberta_BPP_ind_{date_arg.year}.csv"
-        df = pd.read_csv(filename, sep=';', encoding='ISO-8859-1')
-        df = df[df['CNPJ_CIA'] == cnpj]
-        df = df[df['DT_REFER'] == str(date_arg)]
-        df = df[df['DT_FIM_EXERC'] == str(df['DT_FIM_EXERC'].max())]
-        df = df[df['DS_CONTA'] == 'Patrimônio Líquido']
+        bpp = self._load_latest_BPP(date_arg.year)
+        with self.instrumentation.stage("lookup") as stage:
+            df = bpp.lookup(cnpj, str(date_arg))
+            stage.rows = df.shape[0]
+        with self.instrumentation.stage("account_resolution"):
+            df = df[df['DS_CONTA'] == 'Patrimônio Líquido']
         if df.shape[0] > 0:
             book_value = df['VL_CONTA'].iloc[0]
         else:
@@ -126,6 +234,92 @@ class EquityResearch():
             raise Exception(error_msg)
         return book_value
 
+    def _load_latest_statement(self, statement: str, year: int) -> StatementIndex:
+        if statement == "DRE":
+            return self._load_latest_DRE(year)
+        return self._load_latest_BPP(year)
+
+    def get_fundamentals(self, tickers: list, dates: list, fields=None) -> (pd.DataFrame(), pd.DataFrame()):
+        '''
+        Every field of FUNDAMENTAL_FIELDS for every ticker and date, in one pass per statement and year:
+        the statement table of a year is filtered to all requested companies and dates at once, and each account is
+        resolved with vectorized operations. Values follow the single-value getters (get_gross_revenue,
+        get_net_profit, get_book_value...).
+
+        Returns (fundamentals, errors):
+        -> fundamentals: tidy DataFrame with ticker, date, field and value;
+        -> errors: one row per cell that has no value (level "error") or fell back to 0.0 (level "warning"),
+           with ticker, date, field, level and message. Nothing is raised for a single missing cell.
+        '''
+        this_function_name = "get_fundamentals"
+        fields = list(FUNDAMENTAL_FIELDS.keys()) if fields is None else fields
+        unknown_fields = [field for field in fields if field not in FUNDAMENTAL_FIELDS]
+        if len(unknown_fields) > 0:
+            raise Exception(f"[{this_function_name}] Unknown fields {unknown_fields}. Available fields: {list(FUNDAMENTAL_FIELDS.keys())}.")
+
+        values = []
+        errors = []
+
+        requests = pd.DataFrame([(ticker, date_arg) for ticker in tickers for date_arg in dates], columns=['ticker', 'date'])
+        requests['CNPJ_CIA'] = requests['ticker'].map(self._ticker_map.ticker_to_cnpj)
+        requests['DT_REFER'] = requests['date'].astype(str)
+        requests['year'] = [date_arg.year for date_arg in requests['date']]
+
+        unknown_tickers = requests[requests['CNPJ_CIA'].isna()]
+        for field in fields:
+            errors.append(unknown_tickers[['ticker', 'date']].assign(field=field, level="error", message="CNPJ not found for ticker."))
+        requests = requests[requests['CNPJ_CIA'].notna()]
+
+        for year, year_requests in requests.groupby('year'):
+            for statement in set(FUNDAMENTAL_FIELDS[field].statement for field in fields):
+                statement_fields = [field for field in fields if FUNDAMENTAL_FIELDS[field].statement == statement]
+                try:
+                    table = self._load_latest_statement(statement, year).table
+                except:
+                    for field in statement_fields:
+                        errors.append(year_requests[['ticker', 'date']].assign(field=field, level="error", message=f"{statement} data from year {year} not found."))
+                    continue
+
+                with self.instrumentation.stage("filter") as stage:
+                    statement_requests = year_requests
+                    if pd.api.types.is_datetime64_any_dtype(table['DT_REFER']):
+                        statement_requests = year_requests.assign(DT_REFER=pd.to_datetime(year_requests['DT_REFER']).astype(table['DT_REFER'].dtype))
+                    table = table[table['CNPJ_CIA'].isin(statement_requests['CNPJ_CIA'].unique()) & table['DT_REFER'].isin(statement_requests['DT_REFER'].unique())]
+                    stage.rows = table.shape[0]
+
+                with self.instrumentation.stage("account_resolution"):
+                    for field in statement_fields:
+                        spec = FUNDAMENTAL_FIELDS[field]
+                        accounts = table[table[spec.column] == spec.value][['CNPJ_CIA', 'DT_REFER', 'VL_CONTA']]
+                        found = accounts.drop_duplicates(['CNPJ_CIA', 'DT_REFER'])
+                        if spec.zero_fallback:
+                            non_zero = accounts[accounts['VL_CONTA'] != 0.0].drop_duplicates(['CNPJ_CIA', 'DT_REFER'])
+                            found = found[['CNPJ_CIA', 'DT_REFER']].merge(non_zero, how='left', on=['CNPJ_CIA', 'DT_REFER'])
+
+                        cells = statement_requests.merge(found, how='left', on=['CNPJ_CIA', 'DT_REFER'], indicator=True)
+                        missing = cells['_merge'] == 'left_only'
+                        zero = (~missing) & cells['VL_CONTA'].isna()
+
+                        errors.append(cells.loc[missing, ['ticker', 'date']].assign(field=field, level="error", message=f"{field} not found."))
+                        errors.append(cells.loc[zero, ['ticker', 'date']].assign(field=field, level="warning", message=f"{field} is 0.0."))
+                        cells.loc[zero, 'VL_CONTA'] = 0.0
+                        values.append(cells.loc[~missing, ['ticker', 'date', 'VL_CONTA']].rename(columns={'VL_CONTA': 'value'}).assign(field=field))
+
+        fundamentals = pd.concat(values, ignore_index=True) if len(values) > 0 else pd.DataFrame(columns=['ticker', 'date', 'value', 'field'])
+        fundamentals = fundamentals[['ticker', 'date', 'field', 'value']]
+        errors = pd.concat(errors, ignore_index=True) if len(errors) > 0 else pd.DataFrame(columns=['ticker', 'date', 'field', 'level', 'message'])
+        return fundamentals, errors
+
+    def instrumentation_summary(self) -> dict:
+        '''
+        -> stages: calls, total/mean/max wall time and rows per stage since the last reset_instrumentation();
+        -> cache: statement cache statistics (hits, misses, evictions, size).
+        '''
+        return {"stages": self.instrumentation.to_frame(), "cache": self.cache.stats}
+
+    def reset_instrumentation(self):
+        self.instrumentation.reset()
+
     def get_paid_dividends(self, ticker: str, date_arg: date) -> float:
         #TODO
         pass
@@ -0,0 +1,105 @@
+import pandas as pd
+import atexit
+import logging
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+STAGE_FIELDS = ["calls", "total_time", "mean_time", "max_time", "rows"]
+
+class Instrumentation():
+    '''
+    Wall time and row counts per query stage (file_load, resolution, lookup, account_resolution...).
+    A stage is timed with:
+        with instrumentation.stage("file_load") as stage:
+            df = ...
+            stage.rows = df.shape[0]
+    Disabled, stage() still yields but nothing is recorded.
+    '''
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._stages = {}
+
+    class _Stage():
+        __slots__ = ["rows"]
+        def __init__(self):
+            self.rows = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        current = self._Stage()
+        if not self.enabled:
+            yield current
+            return
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self._stages.setdefault(name, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += current.rows
+
+    def reset(self):
+        self._stages = {}
+
+    def to_frame(self) -> pd.DataFrame():
+        df = pd.DataFrame([(name, calls, total, total/calls, max_time, rows) for name, (calls, total, max_time, rows) in self._stages.items()], columns=["stage"] + STAGE_FIELDS)
+        return df.set_index("stage")
+
+_open_sinks = weakref.WeakSet()
+
+@atexit.register
+def _flush_open_sinks():
+    for sink in list(_open_sinks):
+        sink.flush()
+
+class AuditSink():
+    '''
+    Deferred debug dumps: add() only keeps a reference to the frame; every batch_size frames (and at close(), at the
+    end of a with block, when the sink is garbage collected or at exit) they are written together, tagged by key, to
+    one parquet file of directory. Only a weak reference is kept for the exit flush, so a sink dropped by its owner
+    doesn't hold its frames until the end of the process.
+    '''
+    def __init__(self, directory="log/audit", batch_size=100):
+        self.directory = Path(directory)
+        self.batch_size = batch_size
+        self._pending = []
+        self.n_files = 0
+        _open_sinks.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.flush()
+        _open_sinks.discard(self)
+
+    def __del__(self):
+        self.flush()
+
+    def add(self, key: str, df: pd.DataFrame()):
+        self._pending.append(df.assign(audit_key=key))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._pending) == 0:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        filename = self.directory / f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{id(self)}_{self.n_files}.parquet"
+        df = pd.concat(self._pending, ignore_index=True)
+        # Columns of mixed types (e.g. DT_REFER as str and as datetime) are stored as text.
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].astype(str)
+        df.to_parquet(filename, index=False)
+        logging.info(f"[AuditSink] {len(self._pending)} frames written to {filename}.")
+        self._pending = []
+        self.n_files += 1
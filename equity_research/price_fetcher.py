@@ -0,0 +1,143 @@
+import pandas as pd
+import yahooquery as yf
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from pathlib import Path
+from tqdm import tqdm
+import logging
+import threading
+import time
+
+PRICE_CACHE_DIR = "data/us/prices"
+NEXT_QUARTER_BARS = 60
+YAHOO_NO_DATA = "No data found"
+
+class TokenBucket():
+    '''
+    Thread-safe token bucket: acquire() takes one token, waiting for it when the bucket is empty. Tokens refill at
+    rate per second up to capacity, so bursts of capacity requests are allowed but the long run rate is bounded.
+    '''
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last)*self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens)/self.rate
+            time.sleep(wait_time)
+
+class YahooPriceSource():
+    '''
+    Daily bars from Yahoo Finance through yahooquery. Any object with the same history(ticker, start) method can
+    replace it (e.g. a stub returning fixed frames, to run PriceFetcher offline). With start, a ticker without bars
+    since start (up to date, weekend, holiday) gives an empty frame; any other answer without bars is an error.
+    '''
+    @staticmethod
+    def _is_empty_range(df, ticker: str) -> bool:
+        # A range without bars comes back as an empty frame, or as {ticker: chart result without timestamps} or
+        # {ticker: "No data found"} on older yahooquery versions. Error descriptions are other strings.
+        if isinstance(df, pd.DataFrame):
+            return df.shape[0] == 0
+        if isinstance(df, dict):
+            answer = df.get(ticker)
+            return (isinstance(answer, dict) and "timestamp" not in answer) or answer == YAHOO_NO_DATA
+        return False
+
+    def history(self, ticker: str, start=None) -> pd.DataFrame():
+        if start is None:
+            df = yf.Ticker(ticker).history(period='max')
+        else:
+            df = yf.Ticker(ticker).history(start=str(start))
+            if self._is_empty_range(df, ticker):
+                return pd.DataFrame()
+        if not isinstance(df, pd.DataFrame):
+            raise Exception(f"[YahooPriceSource] {ticker}: {df}")
+        return df.reset_index()
+
+def _normalize_dates(dates: pd.Series()) -> pd.Series():
+    # yahooquery mixes dates and tz-aware timestamps: keep the exchange wall time, without timezone.
+    timestamps = [pd.Timestamp(d) for d in dates]
+    return pd.to_datetime([d.tz_localize(None) if d.tzinfo is not None else d for d in timestamps])
+
+class PriceFetcher():
+    '''
+    Downloads the price history of many tickers with n_workers threads, a token bucket of rate requests per second
+    (bursts up to burst) and one parquet cache per ticker in cache_dir. A cached ticker only asks for the bars after
+    its last stored date. Tickers that fail are kept in failures, and retry_failures() fetches them again.
+    '''
+    def __init__(self, source=None, cache_dir=PRICE_CACHE_DIR, n_workers=8, rate=2.0, burst=5):
+        self.source = source if source is not None else YahooPriceSource()
+        self.cache_dir = Path(cache_dir)
+        self.n_workers = n_workers
+        self.bucket = TokenBucket(rate, burst)
+        self.failures = []
+
+    def _cache_file(self, ticker: str) -> Path:
+        return self.cache_dir / f"{ticker.replace('/', '_')}.parquet"
+
+    def load_cached(self, ticker: str) -> pd.DataFrame():
+        cache_file = self._cache_file(ticker)
+        if cache_file.exists():
+            return pd.read_parquet(cache_file)
+        return None
+
+    def fetch_ticker(self, ticker: str) -> pd.DataFrame():
+        '''
+        Cached history of ticker, updated with the new bars (none when it is up to date), with price_next_quarter
+        (adjclose 60 bars later) recomputed over the whole history. Raises only when there is neither cache nor data.
+        '''
+        cached = self.load_cached(ticker)
+        start = None if cached is None else (cached['date'].max() + timedelta(days=1)).date()
+
+        self.bucket.acquire()
+        new_bars = self.source.history(ticker, start)
+        if new_bars.shape[0] > 0:
+            new_bars = new_bars.assign(date=_normalize_dates(new_bars['date'])).drop(columns=['price_next_quarter'], errors='ignore')
+        if cached is not None:
+            new_bars = pd.concat([cached.drop(columns=['price_next_quarter']), new_bars], ignore_index=True)
+        df = new_bars.drop_duplicates('date', keep='last').sort_values('date').reset_index(drop=True)
+        if df.shape[0] == 0:
+            raise Exception(f"[fetch_ticker] No prices for {ticker}.")
+
+        df['price_next_quarter'] = df['adjclose'].shift(-NEXT_QUARTER_BARS)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(self._cache_file(ticker), index=False)
+        return df
+
+    def fetch(self, tickers: list) -> pd.DataFrame():
+        '''
+        Concatenated histories of tickers, in the order given. Failed tickers are logged and listed in failures; the
+        ones with a cache keep their cached history.
+        '''
+        histories = {}
+        failures = []
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = {executor.submit(self.fetch_ticker, ticker): ticker for ticker in tickers}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                ticker = futures[future]
+                try:
+                    histories[ticker] = future.result()
+                except Exception as e:
+                    logging.error(f"[fetch] {ticker} not found. May be deslisted or it doesn't exist. {e}")
+                    failures.append(ticker)
+                    cached = self.load_cached(ticker)
+                    if cached is not None:
+                        histories[ticker] = cached
+        self.failures = failures
+        frames = [histories[ticker] for ticker in tickers if ticker in histories]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['symbol', 'date', 'adjclose', 'price_next_quarter'])
+        return pd.concat(frames, ignore_index=True)
+
+    def retry_failures(self) -> pd.DataFrame():
+        return self.fetch(list(self.failures))
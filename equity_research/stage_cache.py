@@ -0,0 +1,89 @@
+import pandas as pd
+import hashlib
+import inspect
+import json
+import logging
+import os
+from pathlib import Path
+
+STAGE_CACHE_DIR = "data/us/stage_cache"
+
+class StageCache():
+    '''
+    Content-addressed parquet cache of pipeline stage outputs (build_feature_engineering, build_dataset...).
+    The key of an output is the hash of the stage name, of the content of its input files and of the code and
+    parameters that produced it, so a stage is recomputed only when one of them changes. File hashes are memoized
+    by (path, size, mtime) in hashes.json to avoid reading large inputs again.
+    '''
+    def __init__(self, directory=STAGE_CACHE_DIR):
+        self.directory = Path(directory)
+        self._hashes_file = self.directory / "hashes.json"
+        self._file_hashes = None
+
+    def _file_hash(self, filename) -> str:
+        if self._file_hashes is None:
+            self._file_hashes = json.loads(self._hashes_file.read_text()) if self._hashes_file.exists() else {}
+        stat = os.stat(filename)
+        memo_key = f"{Path(filename).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+        if memo_key not in self._file_hashes:
+            sha = hashlib.sha256()
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(1024*1024), b""):
+                    sha.update(chunk)
+            self._file_hashes[memo_key] = sha.hexdigest()
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._hashes_file.write_text(json.dumps(self._file_hashes))
+        return self._file_hashes[memo_key]
+
+    def key(self, stage: str, input_files=(), code=(), params=()) -> str:
+        '''
+        -> input_files: files the stage reads;
+        -> code: modules/functions whose source defines the stage;
+        -> params: anything else changing the output, hashed through repr.
+        '''
+        sha = hashlib.sha256(stage.encode())
+        for filename in input_files:
+            sha.update(self._file_hash(filename).encode())
+        for obj in code:
+            sha.update(inspect.getsource(obj).encode())
+        sha.update(repr(params).encode())
+        return f"{stage}-{sha.hexdigest()[:24]}"
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.parquet"
+
+    def exists(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def save(self, key: str, df: pd.DataFrame()):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_file = self._path(key).with_suffix(".tmp")
+        df.to_parquet(tmp_file)
+        os.replace(tmp_file, self._path(key))
+        logging.info(f"[StageCache] {key} saved.")
+
+    def load(self, key: str, columns=None, fiscal_date_range=None) -> pd.DataFrame():
+        '''
+        Cached output, optionally only some columns and the rows with fiscal_date in [start, end] (both datetime.date,
+        either can be None), filtered while reading.
+        '''
+        filters = None
+        if fiscal_date_range is not None:
+            start, end = fiscal_date_range
+            filters = [condition for condition in [('fiscal_date', '>=', start) if start is not None else None, ('fiscal_date', '<=', end) if end is not None else None] if condition is not None]
+            filters = filters if len(filters) > 0 else None
+        return pd.read_parquet(self._path(key), columns=list(columns) if columns is not None else None, filters=filters)
+
+def select(df: pd.DataFrame(), columns=None, fiscal_date_range=None) -> pd.DataFrame():
+    '''
+    Same selection as StageCache.load, on a frame already in memory.
+    '''
+    if fiscal_date_range is not None:
+        start, end = fiscal_date_range
+        mask = df['fiscal_date'].notna()
+        if start is not None:
+            mask &= df['fiscal_date'].map(lambda d: d is not None and d >= start)
+        if end is not None:
+            mask &= df['fiscal_date'].map(lambda d: d is not None and d <= end)
+        df = df[mask]
+    return df if columns is None else df[list(columns)]
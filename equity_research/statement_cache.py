@@ -0,0 +1,79 @@
+import os
+import logging
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 2*1000000000 # 2 GB
+
+class StatementCache():
+    '''
+    In-process LRU cache of parsed CVM statement tables, keyed by e.g. (statement, con/ind, year).
+    Each entry remembers the mtime of its source files and is reloaded when any of them changes. Entries are
+    evicted, least recently used first, when the total in-memory size goes over max_bytes.
+    Cached DataFrames are shared: callers must not modify them in place.
+    '''
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _mtimes(sources: list) -> tuple:
+        return tuple(os.stat(source).st_mtime_ns for source in sources)
+
+    def get(self, key: tuple, sources: list, loader) -> "pd.DataFrame()":
+        '''
+        Returns the cached table for key, calling loader() to (re)build it on a miss or when a source file changed.
+        '''
+        mtimes = self._mtimes(sources)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == mtimes:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+        if entry is not None:
+            logging.info(f"[StatementCache] {key} changed on disk. Reloading.")
+            self.invalidate(key)
+
+        self.misses += 1
+        df = loader()
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes <= self.max_bytes:
+            self._entries[key] = (df, mtimes, nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+        return df
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and len(self._entries) > 0:
+            _key, (_df, _mtimes, nbytes) = self._entries.popitem(last=False)
+            self.current_bytes -= nbytes
+            self.evictions += 1
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._entries.clear()
+            self.current_bytes = 0
+        elif key in self._entries:
+            self.current_bytes -= self._entries.pop(key)[2]
+
+    def set_max_bytes(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "current_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+# Shared by every EquityResearch instance of the process.
+statement_cache = StatementCache()
@@ -0,0 +1,51 @@
+import pandas as pd
+import numpy as np
+
+KEYS = ['CNPJ_CIA', 'DT_REFER']
+
+class StatementIndex():
+    '''
+    CVM statement table sorted by (CNPJ_CIA, DT_REFER), keeping the file order inside each company-quarter.
+    lookup() returns the rows of a company-quarter as a slice of the sorted table instead of scanning it.
+    '''
+    def __init__(self, df: pd.DataFrame()):
+        df = df.sort_values(KEYS, kind='mergesort').reset_index(drop=True)
+        self.table = df
+        self.cnpjs = set(df['CNPJ_CIA'].unique())
+
+        cnpj = df['CNPJ_CIA'].to_numpy()
+        dt_refer = df['DT_REFER'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, (cnpj[1:] != cnpj[:-1]) | (dt_refer[1:] != dt_refer[:-1])])
+        stops = np.r_[starts[1:], df.shape[0]]
+        # Columnar tables hold DT_REFER as datetimes; lookups are always by the 'YYYY-MM-DD' string.
+        dt_keys = dt_refer[starts]
+        if np.issubdtype(dt_keys.dtype, np.datetime64):
+            dt_keys = np.datetime_as_string(dt_keys, unit='D')
+        self._slices = {(cnpj[start], dt_key): (start, stop) for start, stop, dt_key in zip(starts, stops, dt_keys)}
+
+    def has_cnpj(self, cnpj: str) -> bool:
+        return cnpj in self.cnpjs
+
+    def lookup(self, cnpj: str, dt_refer: str) -> pd.DataFrame():
+        start, stop = self._slices.get((cnpj, dt_refer), (0, 0))
+        return self.table.iloc[start:stop]
+
+    def memory_usage(self, deep=True) -> pd.Series():
+        return self.table.memory_usage(deep=deep)
+
+def resolve_latest_dre(df: pd.DataFrame()) -> pd.DataFrame():
+    '''
+    For every company-quarter keeps the rows get_DRE reports: latest VERSAO, ÚLTIMO exercise, then the widest
+    period (earliest DT_INI_EXERC, latest DT_FIM_EXERC). Each step is applied to what the previous one kept.
+    '''
+    df = df[df['VERSAO'] == df.groupby(KEYS, sort=False, observed=True)['VERSAO'].transform('max')]
+    df = df[df['ORDEM_EXERC'] == 'ÚLTIMO']
+    df = df[df['DT_INI_EXERC'] == df.groupby(KEYS, sort=False, observed=True)['DT_INI_EXERC'].transform('min')]
+    df = df[df['DT_FIM_EXERC'] == df.groupby(KEYS, sort=False, observed=True)['DT_FIM_EXERC'].transform('max')]
+    return df
+
+def resolve_latest_bpp(df: pd.DataFrame()) -> pd.DataFrame():
+    '''
+    For every company-quarter keeps the balance sheet rows of the latest DT_FIM_EXERC.
+    '''
+    return df[df['DT_FIM_EXERC'] == df.groupby(KEYS, sort=False, observed=True)['DT_FIM_EXERC'].transform('max')]
@@ -0,0 +1,70 @@
+import pandas as pd
+import pyarrow.dataset as ds
+from equity_research.cvm_columnar import CATEGORICAL_COLUMNS
+
+DEFAULT_CHUNK_ROWS = 100000
+
+def _filter_columns(cnpjs, dt_refer_start, dt_refer_end, accounts, account_column) -> list:
+    columns = []
+    if cnpjs is not None:
+        columns.append('CNPJ_CIA')
+    if dt_refer_start is not None or dt_refer_end is not None:
+        columns.append('DT_REFER')
+    if accounts is not None:
+        columns.append(account_column)
+    return columns
+
+def _filter_chunk(df, cnpjs, dt_refer_start, dt_refer_end, accounts, account_column) -> pd.DataFrame():
+    mask = pd.Series(True, index=df.index)
+    if cnpjs is not None:
+        mask &= df['CNPJ_CIA'].isin(cnpjs)
+    if dt_refer_start is not None:
+        mask &= df['DT_REFER'] >= dt_refer_start
+    if dt_refer_end is not None:
+        mask &= df['DT_REFER'] <= dt_refer_end
+    if accounts is not None:
+        mask &= df[account_column].isin(accounts)
+    return df[mask]
+
+def _scan_csv(filename, columns, cnpjs, dt_refer_start, dt_refer_end, accounts, account_column, chunk_rows):
+    usecols = None
+    if columns is not None:
+        usecols = list(dict.fromkeys(columns + _filter_columns(cnpjs, dt_refer_start, dt_refer_end, accounts, account_column)))
+    # Text columns are forced to str: a chunk holding only codes like "3.01" would otherwise be parsed as float.
+    dtype = {column: str for column in CATEGORICAL_COLUMNS}
+    for chunk in pd.read_csv(filename, encoding='iso-8859-1', sep=';', usecols=usecols, dtype=dtype, chunksize=chunk_rows):
+        chunk = _filter_chunk(chunk, cnpjs, str(dt_refer_start) if dt_refer_start is not None else None, str(dt_refer_end) if dt_refer_end is not None else None, accounts, account_column)
+        if chunk.shape[0] > 0:
+            yield chunk[columns] if columns is not None else chunk
+
+def _scan_parquet(filename, columns, cnpjs, dt_refer_start, dt_refer_end, accounts, account_column, chunk_rows):
+    expression = None
+    conditions = []
+    if cnpjs is not None:
+        conditions.append(ds.field('CNPJ_CIA').isin(list(cnpjs)))
+    if dt_refer_start is not None:
+        conditions.append(ds.field('DT_REFER') >= pd.Timestamp(dt_refer_start))
+    if dt_refer_end is not None:
+        conditions.append(ds.field('DT_REFER') <= pd.Timestamp(dt_refer_end))
+    if accounts is not None:
+        conditions.append(ds.field(account_column).isin(list(accounts)))
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    dataset = ds.dataset(filename, format='parquet')
+    for batch in dataset.to_batches(columns=columns, filter=expression, batch_size=chunk_rows):
+        if batch.num_rows > 0:
+            yield batch.to_pandas()
+
+def scan_statement_file(filename: str, columns=None, cnpjs=None, dt_refer_start=None, dt_refer_end=None, accounts=None, account_column='CD_CONTA', chunk_rows=DEFAULT_CHUNK_ROWS):
+    '''
+    Streams the rows of one statement file (extracted CSV or columnar parquet) that match every given filter:
+    -> cnpjs: CNPJ_CIA values;
+    -> dt_refer_start / dt_refer_end: inclusive DT_REFER bounds (date or 'YYYY-MM-DD');
+    -> accounts: values of account_column (CD_CONTA by default).
+    Only the requested columns are yielded. The CSV is read chunk_rows lines at a time and the parquet file is scanned
+    batch by batch with the filters pushed down, so memory is bounded by chunk_rows plus what matches.
+    '''
+    columns = list(columns) if columns is not None else None
+    scanner = _scan_parquet if str(filename).endswith(".parquet") else _scan_csv
+    yield from scanner(filename, columns, cnpjs, dt_refer_start, dt_refer_end, accounts, account_column, chunk_rows)
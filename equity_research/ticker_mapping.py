@@ -0,0 +1,91 @@
+import pandas as pd
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+MAPPING_FILE = "input/from_ticker_to_cnpj.xlsx"
+FAST_MAPPING_FILE = "input/from_ticker_to_cnpj.json"
+UNIVERSES = ["IBOVCNPJ", "ALLCNPJ"]
+
+# Mappings already loaded in this process, by (universe, source file).
+_loaded_mappings = {}
+
+def _file_hash(filename: str) -> str:
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def build_fast_mapping(source=MAPPING_FILE, fast_file=FAST_MAPPING_FILE) -> dict:
+    '''
+    Regenerates the JSON copy of every sheet of the Excel mapping. The Excel file stays the source of truth: the
+    JSON records its hash and is rebuilt whenever it changes.
+    '''
+    sheets = pd.read_excel(source, sheet_name=UNIVERSES)
+    mapping = {
+        "source_hash": _file_hash(source),
+        "universes": {universe: df[['security', 'CNPJ']].values.tolist() for universe, df in sheets.items()},
+    }
+    with open(fast_file, "w") as f:
+        json.dump(mapping, f, ensure_ascii=False)
+    logging.info(f"[build_fast_mapping] {fast_file} rebuilt from {source}.")
+    return mapping
+
+def _load_fast_mapping(source=MAPPING_FILE, fast_file=FAST_MAPPING_FILE) -> dict:
+    mapping = None
+    if Path(fast_file).exists():
+        with open(fast_file) as f:
+            mapping = json.load(f)
+    if Path(source).exists() and (mapping is None or mapping['source_hash'] != _file_hash(source)):
+        mapping = build_fast_mapping(source, fast_file)
+    if mapping is None:
+        raise Exception(f"[TickerCnpjMap] Neither {source} nor {fast_file} were found.")
+    return mapping
+
+class TickerCnpjMap():
+    '''
+    Ticker <-> CNPJ mapping of one universe (IBOVCNPJ or ALLCNPJ). Nothing is read until the first lookup,
+    and the parsed mapping is shared by every instance of the process.
+    '''
+    def __init__(self, universe="IBOVCNPJ", source=MAPPING_FILE, fast_file=FAST_MAPPING_FILE):
+        if universe not in UNIVERSES:
+            raise Exception(f"[TickerCnpjMap] Unknown universe {universe}. Available universes: {UNIVERSES}.")
+        self.universe = universe
+        self.source = source
+        self.fast_file = fast_file
+        self._pairs = None
+
+    def _load(self):
+        key = (self.universe, self.source)
+        if key not in _loaded_mappings:
+            pairs = _load_fast_mapping(self.source, self.fast_file)['universes'][self.universe]
+            ticker_to_cnpj = {}
+            cnpj_to_tickers = {}
+            for ticker, cnpj in pairs:
+                ticker_to_cnpj.setdefault(ticker, cnpj)
+                cnpj_to_tickers.setdefault(cnpj, [])
+                if ticker not in cnpj_to_tickers[cnpj]:
+                    cnpj_to_tickers[cnpj].append(ticker)
+            _loaded_mappings[key] = (pairs, ticker_to_cnpj, cnpj_to_tickers)
+        self._pairs, self._ticker_to_cnpj, self._cnpj_to_tickers = _loaded_mappings[key]
+
+    @property
+    def ticker_to_cnpj(self) -> dict:
+        if self._pairs is None:
+            self._load()
+        return self._ticker_to_cnpj
+
+    @property
+    def cnpj_to_tickers(self) -> dict:
+        if self._pairs is None:
+            self._load()
+        return self._cnpj_to_tickers
+
+    @property
+    def tickers(self) -> list:
+        return list(self.ticker_to_cnpj.keys())
+
+    @property
+    def frame(self) -> pd.DataFrame():
+        if self._pairs is None:
+            self._load()
+        return pd.DataFrame(self._pairs, columns=['security', 'CNPJ'])
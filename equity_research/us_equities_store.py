@@ -0,0 +1,92 @@
+import pandas as pd
+import numpy as np
+from pathlib import Path
+
+EQUITIES_STORE_PATH = "data/us/equities_db"
+KEY_COLUMNS = ['Ticker', 'Report Date', 'Publish Date']
+PRICE_COLUMNS = ['price', 'price_next_quarter']
+
+def key_hashes(frames: list) -> pd.DataFrame():
+    '''
+    One row_hash per (Ticker, Report Date, Publish Date): sum of the hashes of every row of every frame with that
+    key, so a restatement in any of the statements changes it.
+    '''
+    hashes = [frame[KEY_COLUMNS].assign(row_hash=pd.util.hash_pandas_object(frame.drop(columns=KEY_COLUMNS), index=False).to_numpy()) for frame in frames]
+    return pd.concat(hashes, ignore_index=True).groupby(KEY_COLUMNS, sort=False, dropna=False)['row_hash'].sum().reset_index()
+
+class EquitiesStore():
+    '''
+    Append-only parquet store of the US equities database, as data/us/equities_db/part-{n}.parquet plus keys.parquet,
+    which has one row per (Ticker, Report Date, Publish Date) with:
+    -> row_hash: key_hashes of the statements the rows were built from;
+    -> prices_complete: False while price or price_next_quarter is missing (bars not published yet);
+    -> part: the part holding the current rows of the key. Rewritten keys are appended to a new part and the
+       older rows are ignored by read().
+    '''
+    def __init__(self, path=EQUITIES_STORE_PATH):
+        self.path = Path(path)
+        self._keys = None
+
+    @property
+    def keys_file(self) -> Path:
+        return self.path / "keys.parquet"
+
+    def exists(self) -> bool:
+        return self.keys_file.exists()
+
+    @property
+    def keys(self) -> pd.DataFrame():
+        if self._keys is None:
+            if self.exists():
+                self._keys = pd.read_parquet(self.keys_file)
+            else:
+                self._keys = pd.DataFrame({'Ticker': pd.Series(dtype=object), 'Report Date': pd.Series(dtype='datetime64[ns]'), 'Publish Date': pd.Series(dtype='datetime64[ns]'), 'row_hash': pd.Series(dtype=np.uint64), 'prices_complete': pd.Series(dtype=bool), 'part': pd.Series(dtype=np.int64)})
+        return self._keys
+
+    def stale_keys(self, hashes: pd.DataFrame()) -> pd.DataFrame():
+        '''
+        Keys of hashes that are not stored yet or whose row_hash changed (restated filings).
+        '''
+        stored = self.keys[KEY_COLUMNS + ['row_hash']].rename(columns={'row_hash': 'row_hash_stored'})
+        # Inner merge keeps row_hash uint64 (a left merge would turn it into float).
+        matched = hashes.merge(stored, how='inner', on=KEY_COLUMNS)
+        restated = matched.loc[matched['row_hash'] != matched['row_hash_stored'], KEY_COLUMNS + ['row_hash']]
+        new = hashes[~pd.MultiIndex.from_frame(hashes[KEY_COLUMNS]).isin(pd.MultiIndex.from_frame(stored[KEY_COLUMNS]))]
+        return pd.concat([new, restated], ignore_index=True)
+
+    def incomplete_keys(self, max_age_days=365) -> pd.DataFrame():
+        '''
+        Keys missing prices that were published in the last max_age_days (older ones won't get new bars).
+        '''
+        recent = self.keys['Publish Date'] >= pd.Timestamp.now() - pd.Timedelta(days=max_age_days)
+        return self.keys.loc[~self.keys['prices_complete'] & recent, KEY_COLUMNS + ['row_hash']]
+
+    def append(self, df: pd.DataFrame(), hashes: pd.DataFrame()):
+        '''
+        Writes df as a new part; its keys (with their row_hash from hashes) now point to it.
+        '''
+        if df.shape[0] == 0:
+            return
+        part = int(self.keys['part'].max()) + 1 if self.keys.shape[0] > 0 else 0
+        self.path.mkdir(parents=True, exist_ok=True)
+        df.to_parquet(self.path / f"part-{part}.parquet", index=False)
+
+        complete = df[PRICE_COLUMNS].notna().all(axis=1).groupby([df[column] for column in KEY_COLUMNS], sort=False, dropna=False, observed=True).all().rename('prices_complete').reset_index()
+        new_keys = complete.merge(hashes, how='left', on=KEY_COLUMNS).assign(part=part)
+        keys = pd.concat([self.keys, new_keys[self.keys.columns]], ignore_index=True)
+        self._keys = keys.drop_duplicates(KEY_COLUMNS, keep='last').reset_index(drop=True)
+        self._keys.to_parquet(self.keys_file, index=False)
+
+    def read(self, columns=None) -> pd.DataFrame():
+        '''
+        Current rows of every key, optionally only some columns.
+        '''
+        read_columns = None if columns is None else list(dict.fromkeys(KEY_COLUMNS + list(columns)))
+        frames = []
+        for part, part_keys in self.keys.groupby('part'):
+            df = pd.read_parquet(self.path / f"part-{part}.parquet", columns=read_columns)
+            frames.append(df.merge(part_keys[KEY_COLUMNS], how='inner', on=KEY_COLUMNS))
+        if len(frames) == 0:
+            return pd.DataFrame(columns=read_columns)
+        df = pd.concat(frames, ignore_index=True).sort_values('Publish Date', kind='mergesort').reset_index(drop=True)
+        return df if columns is None else df[list(columns)]
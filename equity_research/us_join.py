@@ -0,0 +1,66 @@
+import pandas as pd
+import numpy as np
+
+MERGE_COLUMNS = ['Ticker', 'Report Date', 'Fiscal Year', 'Fiscal Period', 'Publish Date']
+DATE_COLUMNS = ['Report Date', 'Publish Date']
+PRICE_COLUMNS = ['Publish Date', 'Ticker', 'price', 'price_next_quarter']
+
+def _projection(df: pd.DataFrame(), columns=None, exclude=()) -> list:
+    '''
+    Merge keys of df plus columns (all when None) minus exclude.
+    '''
+    return [column for column in df.columns if column in MERGE_COLUMNS or ((columns is None or column in columns) and column not in exclude)]
+
+def _encode(df: pd.DataFrame(), codes: np.ndarray) -> pd.DataFrame():
+    '''
+    df with Ticker replaced by its integer codes and dates as int64 nanoseconds.
+    '''
+    encoded = {column: df[column].to_numpy() for column in df.columns}
+    encoded['Ticker'] = codes
+    for column in DATE_COLUMNS:
+        if column in encoded:
+            encoded[column] = pd.to_datetime(df[column]).to_numpy(dtype='datetime64[ns]').view(np.int64)
+    return pd.DataFrame(encoded)
+
+def _decode(df: pd.DataFrame(), tickers: pd.Index) -> pd.DataFrame():
+    df['Ticker'] = pd.Categorical.from_codes(df['Ticker'].to_numpy(), categories=tickers)
+    for column in DATE_COLUMNS:
+        df[column] = df[column].to_numpy().view('datetime64[ns]')
+    return df
+
+def join_statements(df_income: pd.DataFrame(), df_balance: pd.DataFrame(), df_cashflow: pd.DataFrame(), df_prices: pd.DataFrame(), columns=None, n_partitions=1) -> pd.DataFrame():
+    '''
+    Left joins income, balance and cashflow on MERGE_COLUMNS, then each filing with the first price bar strictly
+    after its Publish Date (merge_asof forward), as _build_us_equities_db always did, but:
+    -> only the merge keys and columns are kept from each frame (columns=None keeps every column, no projection);
+    -> a column already taken from an earlier frame is not read again (Shares (Diluted) instead of
+       Shares (Diluted)_x/_y);
+    -> tickers are joined as integer codes and dates as int64;
+    -> tickers are split in n_partitions projected, encoded and joined one after the other, so the intermediate
+       frames hold about 1/n_partitions of the rows.
+    df_prices has Publish Date, Ticker, price and price_next_quarter. Ticker comes back categorical and the rows
+    sorted by Publish Date.
+    '''
+    tickers = pd.Index(pd.unique(df_income['Ticker']))
+    income_columns = _projection(df_income, columns)
+    balance_columns = _projection(df_balance, columns, exclude=income_columns)
+    cashflow_columns = _projection(df_cashflow, columns, exclude=income_columns + balance_columns)
+    frames = [(df_income, income_columns), (df_balance, balance_columns), (df_cashflow, cashflow_columns), (df_prices, PRICE_COLUMNS)]
+
+    # Unknown price tickers (code -1) fall in no partition.
+    codes = [tickers.get_indexer(df['Ticker']) for df, _ in frames]
+    partitions = [np.where(frame_codes >= 0, frame_codes*n_partitions//max(len(tickers), 1), -1) for frame_codes in codes]
+    results = []
+    for partition in range(n_partitions):
+        selected = [ids == partition for ids in partitions]
+        if not selected[0].any() and len(results) > 0:
+            continue
+        income_p, balance_p, cashflow_p, prices_p = [_encode(df.loc[rows, frame_columns], frame_codes[rows]) for (df, frame_columns), frame_codes, rows in zip(frames, codes, selected)]
+        db = income_p.merge(balance_p, how='left', on=MERGE_COLUMNS)
+        db = db.merge(cashflow_p, how='left', on=MERGE_COLUMNS)
+        db = pd.merge_asof(db.sort_values('Publish Date', kind='mergesort'), prices_p.sort_values('Publish Date', kind='mergesort'), by='Ticker', on='Publish Date', allow_exact_matches=False, direction='forward')
+        results.append(db)
+
+    db = pd.concat(results, ignore_index=True)
+    db = db.iloc[np.argsort(db['Publish Date'].to_numpy(), kind='stable')].reset_index(drop=True)
+    return _decode(db, tickers)
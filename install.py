@@ -1,11 +1,12 @@
 from download import download_data
+from equity_research import cvm_columnar
 import argparse
 from datetime import datetime
 import psutil
 import simfin as sf
 from pathlib import Path
 
-NECESSARY_SPACE= 10 # in GB
+NECESSARY_SPACE= 10 # in GB, peak usage: every CSV is extracted before the conversion to parquet removes it
 GB = 1000000000.0
 
 def download_cvm():
@@ -16,7 +17,7 @@ def download_cvm():
 
     space_in_gb = psutil.disk_usage(".").free/GB
     if space_in_gb < NECESSARY_SPACE: 
-        raise Exception(f"You don't have enough space. This repository needs approximately 10G to work properly. You have just {space_in_gb} GB free in your hard disk.")
+        raise Exception(f"You don't have enough space. The download needs approximately 10G (the CVM data takes much less once converted to parquet). You have just {space_in_gb} GB free in your hard disk.")
     else:
         answer = input(f"[INFO] Space is not a problem. You have {space_in_gb} GB in your hard disk. Do you want to proceed? [Y/n] ")
         if answer == "Y" or answer == "y":
@@ -32,6 +33,8 @@ def download_cvm():
                 download_data.download_trimestral_data_from_cvm(date_init, date_final)
                 print("[INFO] Downloading anual data from CVM...")
                 download_data.download_anual_data_from_cvm(date_init, date_final)
+                print("[INFO] Converting CVM data to the columnar format and removing the CSV files...")
+                cvm_columnar.ingest(date_init, date_final)
         else:
             print("[INFO] Operation canceled.")
 
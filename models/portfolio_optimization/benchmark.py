@@ -0,0 +1,154 @@
+'''
+Offline benchmark of GeneticPortfolio on synthetic return matrices.
+
+e.g.:
+python -m models.portfolio_optimization.benchmark --n-tickers 10 100 --population-size 100 1000 --output bench.json
+python -m models.portfolio_optimization.benchmark --compare bench_old.json bench.json
+'''
+import pandas as pd
+import numpy as np
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import date, datetime
+from models.portfolio_optimization.genetic_portfolio import GeneticPortfolio
+from models.portfolio_optimization.max_sharpe_qp import solve_max_sharpe
+
+START_DATE = date(2010, 1, 1)
+
+def synthetic_return_matrix(n_tickers: int, n_days: int, n_factors=3, factor_weight=0.5, volatility=0.02, seed=0) -> "pd.DataFrame()":
+    '''
+    Daily returns from a factor model laid out as data/matrix_returns.csv (a 'date' column plus one column per
+    ticker). factor_weight in [0, 1] is the share of each stock variance explained by the common factors, so it
+    controls the correlation between stocks.
+    '''
+    rng = np.random.default_rng(seed)
+    loadings = rng.normal(0, 1, (n_factors, n_tickers))
+    loadings = loadings / np.sqrt(np.sum(loadings**2, axis=0))
+    factors = rng.normal(0, 1, (n_days, n_factors))
+    noise = rng.normal(0, 1, (n_days, n_tickers))
+    returns = volatility*(np.sqrt(factor_weight)*(factors @ loadings) + np.sqrt(1 - factor_weight)*noise)
+
+    df_returns = pd.DataFrame(returns, columns=[f"SYN{i}" for i in range(n_tickers)])
+    df_returns.insert(0, 'date', pd.bdate_range(START_DATE, periods=n_days).date)
+    return df_returns
+
+def synthetic_stock_views(n_tickers: int, seed=0) -> dict:
+    rng = np.random.default_rng(seed)
+    return dict(zip([f"SYN{i}" for i in range(n_tickers)], rng.uniform(0.01, 0.10, n_tickers)))
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_benchmark(n_tickers: int, n_days: int, population_size: int, N_iterations: int, F: float, CR: float, engine="de", factor_weight=0.5, targets=(0.9, 0.99, 0.999), seed=0) -> dict:
+    df_returns = synthetic_return_matrix(n_tickers, n_days, factor_weight=factor_weight, seed=seed)
+    stock_views = synthetic_stock_views(n_tickers, seed)
+    end_date = df_returns['date'].iloc[-1]
+
+    def new_portfolio():
+        return GeneticPortfolio(stock_views, START_DATE, end_date, population_size=population_size, F=F, CR=CR, N_iterations=N_iterations, engine=engine, return_matrix=df_returns, seed=seed, progress_bar=False)
+
+    genport = new_portfolio()
+    _weights, optimal_sharpe_history, _n_iterations, _converged = solve_max_sharpe(genport.expected_returns, genport.covariance_matrix)
+    optimal_sharpe = optimal_sharpe_history[-1]
+
+    start_time = time.perf_counter()
+    genport.fit()
+    elapsed = time.perf_counter() - start_time
+
+    # tracemalloc slows the fit 2-3x (more on small problems), so the peak memory comes from a second, traced run
+    # with the same seed that isn't timed.
+    traced_genport = new_portfolio()
+    tracemalloc.start()
+    traced_genport.fit()
+    _current, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "n_tickers": n_tickers,
+        "n_days": n_days,
+        "population_size": population_size,
+        "N_iterations": N_iterations,
+        "F": F,
+        "CR": CR,
+        "engine": engine,
+        "factor_weight": factor_weight,
+        "seed": seed,
+        "elapsed": elapsed,
+        "n_generations": genport.n_generations,
+        "generations_per_sec": genport.n_generations / elapsed if elapsed > 0 else None,
+        "peak_memory_mb": peak_memory / 1e6,
+        "final_sharpe": float(genport.fitness_array[-1]),
+        "optimal_sharpe": float(optimal_sharpe),
+        "stop_reason": genport.stop_reason,
+    }
+
+    elapsed_array = genport.telemetry.column("elapsed")
+    for target in targets:
+        reached = np.nonzero(genport.fitness_array >= target*optimal_sharpe)[0]
+        result[f"time_to_{target:g}"] = float(elapsed_array[reached[0]]) if reached.shape[0] > 0 else None
+    return result
+
+def run_grid(n_tickers=(10, 100), n_days=(750,), population_size=(100,), N_iterations=(200,), F=(2,), CR=(0.2,), engines=("de",), factor_weight=0.5, seed=0) -> list:
+    results = []
+    grid = list(itertools.product(n_tickers, n_days, population_size, N_iterations, F, CR, engines))
+    for _n_tickers, _n_days, _population_size, _N_iterations, _F, _CR, _engine in grid:
+        print(f"[INFO] n_tickers={_n_tickers} n_days={_n_days} population_size={_population_size} N_iterations={_N_iterations} F={_F} CR={_CR} engine={_engine}")
+        results.append(run_benchmark(_n_tickers, _n_days, _population_size, _N_iterations, _F, _CR, _engine, factor_weight, seed=seed))
+    return results
+
+def save_results(results: list, filename: str):
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "results": results,
+    }
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+
+def compare_results(baseline_file: str, current_file: str) -> "pd.DataFrame()":
+    '''
+    Joins two result files on the benchmark parameters and reports the speedup and Sharpe difference of current vs. baseline.
+    '''
+    keys = ["n_tickers", "n_days", "population_size", "N_iterations", "F", "CR", "engine", "factor_weight", "seed"]
+    with open(baseline_file) as f:
+        df_baseline = pd.DataFrame(json.load(f)['results'])
+    with open(current_file) as f:
+        df_current = pd.DataFrame(json.load(f)['results'])
+    df = df_baseline.merge(df_current, on=keys, suffixes=("_baseline", "_current"))
+    df['speedup'] = df['generations_per_sec_current'] / df['generations_per_sec_baseline']
+    df['sharpe_diff'] = df['final_sharpe_current'] - df['final_sharpe_baseline']
+    df['memory_ratio'] = df['peak_memory_mb_current'] / df['peak_memory_mb_baseline']
+    return df[keys + ['speedup', 'sharpe_diff', 'memory_ratio']]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of GeneticPortfolio on synthetic return matrices.")
+    parser.add_argument("--n-tickers", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--n-days", type=int, nargs="+", default=[750])
+    parser.add_argument("--population-size", type=int, nargs="+", default=[100])
+    parser.add_argument("--n-iterations", type=int, nargs="+", default=[200])
+    parser.add_argument("--F", type=float, nargs="+", default=[2])
+    parser.add_argument("--CR", type=float, nargs="+", default=[0.2])
+    parser.add_argument("--engines", nargs="+", default=["de"])
+    parser.add_argument("--factor-weight", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"))
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare_results(*args.compare).to_string(index=False))
+    else:
+        results = run_grid(args.n_tickers, args.n_days, args.population_size, args.n_iterations, args.F, args.CR, args.engines, args.factor_weight, args.seed)
+        save_results(results, args.output)
+        print(pd.DataFrame(results).to_string(index=False))
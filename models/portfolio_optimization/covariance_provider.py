@@ -0,0 +1,69 @@
+import numpy as np
+from datetime import date
+from models.portfolio_optimization.return_matrix_store import ReturnMatrixStore
+
+class IncrementalCovariance():
+    '''
+    Covariance provider over the full ticker universe of a ReturnMatrixStore. It keeps the running sums and
+    cross-products of the rows currently in the window, so moving from one (start_date, end_date) window to the
+    next only adds/removes the rows that changed. A query then just slices the (tickers x tickers) sub-block.
+    With window set to a number of trading days, start_date is ignored and the last window rows up to end_date
+    are used (rolling window).
+    Returns the sample covariance (ddof=1), the same as pd.DataFrame.cov without missing values.
+    '''
+    def __init__(self, store=None, window=None):
+        if store is None:
+            store = ReturnMatrixStore()
+        self.store = store
+        self.window = window
+        self.first_row = 0
+        self.last_row = 0
+        self.shift = None
+        self.sums = None
+        self.cross_products = None
+
+    def _reset(self, first_row: int, last_row: int):
+        # Sums are accumulated on returns shifted by a fixed per-ticker value to limit cancellation errors.
+        self.shift = np.asarray(self.store.values[first_row:last_row], dtype=np.float64).mean(axis=0)
+        self.sums = np.zeros(len(self.store.tickers))
+        self.cross_products = np.zeros((len(self.store.tickers), len(self.store.tickers)))
+        self.first_row = first_row
+        self.last_row = first_row
+        self._update_rows(first_row, last_row, 1.0)
+        self.last_row = last_row
+
+    def _update_rows(self, first_row: int, last_row: int, sign: float):
+        if last_row <= first_row:
+            return
+        rows = np.asarray(self.store.values[first_row:last_row], dtype=np.float64) - self.shift
+        self.sums += sign*rows.sum(axis=0)
+        self.cross_products += sign*(rows.T @ rows)
+
+    def _move_window(self, first_row: int, last_row: int):
+        n_changed_rows = abs(first_row - self.first_row) + abs(last_row - self.last_row)
+        if self.sums is None or n_changed_rows >= last_row - first_row or last_row <= self.first_row or first_row >= self.last_row:
+            self._reset(first_row, last_row)
+            return
+        self._update_rows(first_row, self.first_row, 1.0)
+        self._update_rows(self.first_row, first_row, -1.0)
+        self._update_rows(self.last_row, last_row, 1.0)
+        self._update_rows(last_row, self.last_row, -1.0)
+        self.first_row = first_row
+        self.last_row = last_row
+
+    def covariance(self, start_date: date, end_date: date, tickers: list) -> "np.array()":
+        rows = self.store.date_range(start_date, end_date)
+        first_row, last_row = rows.start, rows.stop
+        if self.window is not None:
+            first_row = max(0, last_row - self.window)
+
+        n_rows = last_row - first_row
+        if n_rows < 2:
+            raise Exception(f"[IncrementalCovariance] Not enough returns between {start_date} and {end_date} to estimate a covariance.")
+
+        self._move_window(first_row, last_row)
+
+        columns = [self.store.columns[ticker] for ticker in tickers]
+        sums = self.sums[columns]
+        cross_products = self.cross_products[np.ix_(columns, columns)]
+        return (cross_products - np.outer(sums, sums)/n_rows)/(n_rows - 1)
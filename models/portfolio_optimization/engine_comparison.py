@@ -0,0 +1,33 @@
+import pandas as pd
+import time
+from datetime import date
+from models.portfolio_optimization.genetic_portfolio import GeneticPortfolio
+
+def compare_engines(stock_views: dict, start_date: date, end_date: date, engines=("classic", "de", "qp"), return_matrix=None, **portfolio_kwargs) -> "pd.DataFrame()":
+    '''
+    Fits the same inputs with each engine and reports the final Sharpe ratio, the runtime of fit() and the gap to
+    the exact (qp) solution. The return matrix is loaded once and shared by every engine.
+    Extra keyword arguments are forwarded to GeneticPortfolio (population_size, N_iterations, seed...).
+    '''
+    results = []
+    for engine in engines:
+        genport = GeneticPortfolio(stock_views, start_date, end_date, engine=engine, return_matrix=return_matrix, **portfolio_kwargs)
+        return_matrix = genport.return_matrix
+
+        start_time = time.time()
+        genport.fit()
+        runtime = time.time() - start_time
+
+        results.append({
+            "engine": engine,
+            "sharpe": genport._fitness(genport.global_best_chromosome),
+            "runtime": runtime,
+            "n_generations": genport.n_generations,
+            "stop_reason": genport.stop_reason,
+        })
+
+    df_results = pd.DataFrame(results)
+    if "qp" in engines:
+        exact_sharpe = df_results.loc[df_results['engine'] == "qp", 'sharpe'].iloc[0]
+        df_results['sharpe_gap'] = exact_sharpe - df_results['sharpe']
+    return df_results
@@ -4,16 +4,55 @@ import yahooquery as yf
 import matplotlib.pyplot as plt
 from datetime import date
 from tqdm import tqdm
-import plotly.graph_objects as go
+import time
+import os
+from concurrent.futures import ProcessPoolExecutor
+from models.portfolio_optimization.return_matrix_store import ReturnMatrixStore
+from models.portfolio_optimization.max_sharpe_qp import solve_max_sharpe
+from models.portfolio_optimization.telemetry import FitTelemetry, LivePlotCallback
+
+ENGINES = ["classic", "de", "qp", "islands"]
+
+def load_returns_matrix(filename="data/matrix_returns.csv") -> "pd.DataFrame()":
+    df_returns = pd.read_csv(filename, parse_dates=['date'])
+    df_returns['date'] = df_returns['date'].dt.date
+    df_returns = df_returns.fillna(0) #gambiarra
+    return df_returns
+
+# Island model: every worker process receives its own copy of the GeneticPortfolio once, then evolves the
+# islands it is given for migration_interval generations at a time.
+_island_worker = {}
+
+def _init_island_worker(genport: "GeneticPortfolio"):
+    _island_worker['genport'] = genport
+
+def _evolve_island(population: "np.array()", fitness: "np.array()", rng: "np.random.Generator", n_generations: int) -> tuple:
+    genport = _island_worker['genport']
+    genport.rng = rng
+    history = np.empty(n_generations)
+    for generation in range(0, n_generations):
+        population, fitness = genport._differential_evolution_step(population, fitness)
+        history[generation] = np.max(fitness)
+    return population, fitness, genport.rng, history
 
 class GeneticPortfolio():
-    def __init__(self, stock_views: dict, start_date: date, end_date: date, population_size=1000, F=2, CR=0.2, N_iterations=1000, live_plot=False, K=60):
+    def __init__(self, stock_views: dict, start_date: date, end_date: date, population_size=1000, F=2, CR=0.2, N_iterations=1000, live_plot=False, K=60, engine="classic", tol=1e-6, patience=50, diversity_tol=1e-8, max_time=None, return_matrix=None, seed=None, progress_bar=True, covariance_provider=None, n_islands=None, migration_interval=25, n_migrants=1, n_workers=None, callbacks=None, callback_interval=1):
         self.list_of_stocks = list(stock_views.keys())
         self.expected_returns = np.array(list(stock_views.values()))
         self.start_date = start_date
         self.end_date = end_date
-        self.return_matrix = self._get_portfolio_returns_matrix()
-        self.covariance_matrix = np.array(self.return_matrix.cov()*K)
+        if covariance_provider is not None:
+            self.return_matrix = None
+            self.covariance_matrix = covariance_provider.covariance(start_date, end_date, self.list_of_stocks)*K
+        else:
+            if return_matrix is None:
+                self.return_matrix = self._get_portfolio_returns_matrix()
+            else:
+                self.return_matrix = return_matrix[self.list_of_stocks]
+            self.covariance_matrix = np.array(self.return_matrix.cov()*K)
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        self.progress_bar = progress_bar
         self.number_of_gens = len(self.list_of_stocks)
         self.population_size = population_size
         self.F = F
@@ -21,12 +60,31 @@ class GeneticPortfolio():
         self.N_iterations = N_iterations
         self.global_best_chromosome = None
         self.live_plot = live_plot
+        self.engine = engine
+        self.tol = tol
+        self.patience = patience
+        self.diversity_tol = diversity_tol
+        self.max_time = max_time
+        self.stop_reason = None
+        self.n_generations = 0
+        self.n_islands = n_islands if n_islands is not None else os.cpu_count()
+        self.migration_interval = migration_interval
+        self.n_migrants = n_migrants
+        self.n_workers = n_workers
+
+        if self.engine not in ENGINES:
+            raise Exception(f"[GeneticPortfolio] Unknown engine {self.engine}. Available engines: {ENGINES}.")
+
+        # Callbacks are called as callback(genport, record) every callback_interval generations, record being the
+        # last row of self.telemetry as a dict.
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.callback_interval = callback_interval
+        self.telemetry = None
 
         if self.live_plot:
-            self.live_fig = go.FigureWidget()
-            self.live_fig.layout.title = 'Fitness Evolution along generations'
-            self.live_fig.layout.xaxis.title = "Generation"
-            self.live_fig.layout.yaxis.title = "Fitness (Sharpe Ratio)"
+            live_plot_callback = LivePlotCallback()
+            self.callbacks.append(live_plot_callback)
+            self.live_fig = live_plot_callback.figure
         
         # Litterman Factors
         '''
@@ -40,15 +98,25 @@ class GeneticPortfolio():
         self.views_vector = np.full(shape=self.number_of_gens, fill_value=0.05, dtype=float)
         '''
 
+    def __getstate__(self) -> dict:
+        # The plotly widget and the callbacks can't be sent to worker processes.
+        state = self.__dict__.copy()
+        state.pop('live_fig', None)
+        state['live_plot'] = False
+        state['callbacks'] = []
+        return state
+
     def real_time_plot(self) -> "go.FigureWidget()":
         if self.live_plot:
-            self.live_fig.add_scatter()
+            if len(self.live_fig.data) == 0:
+                self.live_fig.add_scatter()
             return self.live_fig
 
     def _get_portfolio_returns_matrix(self) -> "pd.DataFrame()": 
-        df_returns = pd.read_csv("data/matrix_returns.csv", parse_dates=['date'])
-        df_returns['date'] = df_returns['date'].dt.date
-        df_returns = df_returns.fillna(0) #gambiarra
+        store = ReturnMatrixStore.open_synced()
+        if store is not None:
+            return store.get_returns(self.start_date, self.end_date, self.list_of_stocks)
+        df_returns = load_returns_matrix()
         df_returns = df_returns[(df_returns['date'] >= self.start_date) & (df_returns['date'] <= self.end_date)]
         df_returns = df_returns[self.list_of_stocks]
         return df_returns
@@ -71,39 +139,34 @@ class GeneticPortfolio():
         Restrictions:
         -> All weights must be positives;
         -> Sum of weights must be equal 1.
+        Works on a single chromosome or row-wise on a whole population.
         '''
-        _chromosome = chromosome.copy()
-        _chromosome = np.abs(_chromosome)
-        _chromosome = _chromosome / np.sum(_chromosome)
+        _chromosome = np.abs(chromosome)
+        _chromosome = _chromosome / np.sum(_chromosome, axis=-1, keepdims=True)
         return _chromosome
 
     def _generate_random_chromosome(self) -> "np.array()":
-        w = np.random.random(self.number_of_gens)
+        w = self.rng.random(self.number_of_gens)
         w = self._apply_restriction(w)
         return w
 
     def _generate_population(self) -> "np.array()":
-        population=[]
-        for _i in range(0, self.population_size):
-            population.append(self._generate_random_chromosome())
-        return np.array(population)
+        population = self.rng.random((self.population_size, self.number_of_gens))
+        return self._apply_restriction(population)
 
     def _recombination(self, chromosome: "np.array()", population: "np.array()") -> "np.array()":
         '''
         Recombining to perform genetic variability among the population.
         '''
-        chromosome_1 = population[np.random.randint(0, self.population_size)]   # Choose random chromosome 1 from given population
-        chromosome_2 = population[np.random.randint(0, self.population_size)]   # Choose random chromosome 2 from given population
+        chromosome_1 = population[self.rng.integers(0, self.population_size)]   # Choose random chromosome 1 from given population
+        chromosome_2 = population[self.rng.integers(0, self.population_size)]   # Choose random chromosome 2 from given population
         chromosome_modified = chromosome + self.F*(chromosome_1 - chromosome_2) # Perform linear combination => simulating sexual recombination
         chromosome_modified = self._apply_restriction(chromosome_modified)      
         return chromosome_modified
 
     def _mutation(self, chromosome: "np.array()", best_chromosome: "np.array()") -> "np.array()":
-        _chromosome = chromosome.copy()
-        for gene in range(0, self.number_of_gens):
-            rand = np.random.uniform(0,1)
-            if rand <= self.CR:
-                _chromosome[gene] = best_chromosome[0]
+        mask = self.rng.uniform(0, 1, self.number_of_gens) <= self.CR
+        _chromosome = np.where(mask, best_chromosome[0], chromosome)
         _chromosome = self._apply_restriction(_chromosome)
         return _chromosome
 
@@ -112,55 +175,276 @@ class GeneticPortfolio():
         portfolio_vol = self._portfolio_vol(chromosome)
         return portfolio_return/portfolio_vol
 
+    def _population_recombination(self, population: "np.array()") -> "np.array()":
+        '''
+        Same as _recombination, but every chromosome of the population draws its two donors at once.
+        '''
+        donors = self.rng.integers(0, self.population_size, size=(2, self.population_size))
+        population_modified = population + self.F*(population[donors[0]] - population[donors[1]])
+        return self._apply_restriction(population_modified)
+
+    def _population_mutation(self, population: "np.array()", best_chromosome: "np.array()") -> "np.array()":
+        '''
+        Same as _mutation, with the per-gene coin flips drawn as a single (population x genes) mask.
+        '''
+        mask = self.rng.uniform(0, 1, population.shape) <= self.CR
+        _population = np.where(mask, best_chromosome[0], population)
+        return self._apply_restriction(_population)
+
+    def _population_fitness(self, population: "np.array()") -> "np.array()":
+        '''
+        Sharpe ratio of every chromosome (row) of the population in a single pass.
+        '''
+        portfolio_returns = population @ self.expected_returns
+        portfolio_vars = np.einsum('ij,ij->i', population @ self.covariance_matrix, population)
+        return portfolio_returns/np.sqrt(portfolio_vars)
+
+    def _population_crossover(self, population: "np.array()", mutant_population: "np.array()") -> "np.array()":
+        '''
+        Binomial crossover: each gene comes from the mutant with probability CR, and at least one gene always does.
+        '''
+        mask = self._crossover_mask(population.shape)
+        trial_population = np.where(mask, mutant_population, population)
+        return self._apply_restriction(trial_population)
+
+    def _crossover_mask(self, shape: tuple) -> "np.array()":
+        mask = self.rng.uniform(0, 1, shape) <= self.CR
+        mask[np.arange(shape[0]), self.rng.integers(0, shape[1], shape[0])] = True
+        return mask
+
+    def _population_diversity(self, population: "np.array()") -> float:
+        return np.mean(np.std(population, axis=0))
+
     def _initialize_genetic_algo(self) -> (float):
 
         old_population = self._generate_population()
+        fitness = self._population_fitness(old_population)
 
-        max_fitness = -np.inf
-        best_chromosome = None
-
-        for chromosome in old_population:
-            fit = self._fitness(chromosome)
-            if fit > max_fitness:
-                max_fitness = fit
-                best_chromosome = chromosome
+        best_index = np.argmax(fitness)
+        max_fitness = fitness[best_index]
+        best_chromosome = old_population[best_index]
 
         return max_fitness, best_chromosome
 
+    def _start_telemetry(self, max_generations: int):
+        self.telemetry = FitTelemetry(max_generations)
+        self._fit_start_time = time.perf_counter()
+        self._evaluations = 0
+
+    def _record_generation(self, generation: int, best_fitness: float, fitness=None, diversity=np.nan, evaluations=0, phase_times=(np.nan, np.nan, np.nan)):
+        '''
+        Appends one generation to self.telemetry and calls the callbacks every callback_interval generations.
+        '''
+        elapsed = time.perf_counter() - self._fit_start_time
+        self._evaluations += evaluations
+        record = self.telemetry.record(
+            generation=generation,
+            elapsed=elapsed,
+            best_fitness=best_fitness,
+            mean_fitness=np.mean(fitness) if fitness is not None else np.nan,
+            std_fitness=np.std(fitness) if fitness is not None else np.nan,
+            diversity=diversity,
+            evaluations=self._evaluations,
+            evaluations_per_sec=self._evaluations/elapsed if elapsed > 0 else np.nan,
+            variation_time=phase_times[0],
+            fitness_time=phase_times[1],
+            selection_time=phase_times[2],
+        )
+        if generation % self.callback_interval == 0:
+            self._run_callbacks(record)
+
+    def _run_callbacks(self, record: dict):
+        for callback in self.callbacks:
+            callback(self, record)
+
+    def _end_telemetry(self):
+        # Last generation always reaches the callbacks, even when it is not a multiple of callback_interval.
+        last_generation = int(self.telemetry.last['generation'])
+        if last_generation % self.callback_interval != 0:
+            self._run_callbacks(self.telemetry.last)
+        self.fitness_array = self.telemetry.column("best_fitness").copy()
 
     def fit(self):
+        if self.engine == "de":
+            self._fit_differential_evolution()
+        elif self.engine == "islands":
+            self._fit_islands()
+        elif self.engine == "qp":
+            self._fit_exact()
+        else:
+            self._fit_classic()
+        self._end_telemetry()
+
+    def _fit_classic(self):
+        self._start_telemetry(self.N_iterations)
         max_fitness, best_chromosome = self._initialize_genetic_algo()
-        max_fitness_array = np.array([])
-        max_fitness_array =  np.append(max_fitness_array, max_fitness)
+        self._record_generation(0, max_fitness, evaluations=self.population_size)
         
-        for i in tqdm(range(0, self.N_iterations)):
+        for i in tqdm(range(0, self.N_iterations), disable=not self.progress_bar):
 
+            phase_start = time.perf_counter()
             intermediate_population = self._generate_population()
-            for chromosome in intermediate_population:
-                recombined_chromosome = self._recombination(chromosome, intermediate_population)
-                mutated_chromosome = self._mutation(recombined_chromosome, best_chromosome)
-
-                fitness_not_mutated = self._fitness(chromosome)
-                fitness_mutated = self._fitness(mutated_chromosome)
-
-                if fitness_mutated > fitness_not_mutated:
-                    _aux_max_fitness = fitness_mutated
-                    _aux_best_chromosome = mutated_chromosome
+            recombined_population = self._population_recombination(intermediate_population)
+            mutated_population = self._population_mutation(recombined_population, best_chromosome)
+            variation_end = time.perf_counter()
+
+            fitness_not_mutated = self._population_fitness(intermediate_population)
+            fitness_mutated = self._population_fitness(mutated_population)
+            fitness_end = time.perf_counter()
+
+            # Per chromosome, keep the fittest between parent and mutated child, then take the best of the generation.
+            take_mutated = fitness_mutated > fitness_not_mutated
+            generation_fitness = np.where(take_mutated, fitness_mutated, fitness_not_mutated)
+            best_index = np.argmax(generation_fitness)
+
+            if generation_fitness[best_index] > max_fitness:
+                max_fitness = generation_fitness[best_index]
+                if take_mutated[best_index]:
+                    best_chromosome = mutated_population[best_index]
                 else:
-                    _aux_max_fitness = fitness_not_mutated
-                    _aux_best_chromosome = chromosome
-
-                if _aux_max_fitness > max_fitness:
-                    max_fitness = _aux_max_fitness
-                    best_chromosome = _aux_best_chromosome
-                
-            max_fitness_array =  np.append(max_fitness_array, max_fitness)
+                    best_chromosome = intermediate_population[best_index]
+            selection_end = time.perf_counter()
 
-            if self.live_plot:
-                self.live_fig.data[0].y = max_fitness_array[:i]
+            phase_times = (variation_end - phase_start, fitness_end - variation_end, selection_end - fitness_end)
+            self._record_generation(i + 1, max_fitness, generation_fitness, self._population_diversity(mutated_population), 2*self.population_size, phase_times)
         
-        self.fitness_array = max_fitness_array
         self.global_best_chromosome = best_chromosome
+        self.stop_reason = "max_iterations"
+        self.n_generations = self.N_iterations
+
+    def _differential_evolution_step(self, population: "np.array()", fitness: "np.array()") -> tuple:
+        phase_start = time.perf_counter()
+        mutant_population = self._population_recombination(population)
+        trial_population = self._population_crossover(population, mutant_population)
+        variation_end = time.perf_counter()
+
+        trial_fitness = self._population_fitness(trial_population)
+        fitness_end = time.perf_counter()
+
+        improved = trial_fitness >= fitness
+        population[improved] = trial_population[improved]
+        fitness[improved] = trial_fitness[improved]
+
+        self._phase_times = (variation_end - phase_start, fitness_end - variation_end, time.perf_counter() - fitness_end)
+        return population, fitness
+
+    def _fit_differential_evolution(self):
+        '''
+        Differential evolution keeping a persistent population: every individual is replaced by its trial only when
+        the trial is at least as fit. Stops on the first of:
+        -> "max_iterations": N_iterations generations done;
+        -> "fitness_tolerance": best fitness improved less than tol over the last patience generations;
+        -> "diversity_collapse": mean per-gene standard deviation of the population below diversity_tol;
+        -> "time_budget": more than max_time seconds elapsed.
+        '''
+        self._start_telemetry(self.N_iterations)
+        population = self._generate_population()
+        fitness = self._population_fitness(population)
+        self._record_generation(0, np.max(fitness), fitness, self._population_diversity(population), self.population_size)
+
+        stop_reason = "max_iterations"
+        generation = 0
+
+        for i in tqdm(range(0, self.N_iterations), disable=not self.progress_bar):
+
+            population, fitness = self._differential_evolution_step(population, fitness)
+            diversity = self._population_diversity(population)
+            generation = i + 1
+            self._record_generation(generation, np.max(fitness), fitness, diversity, self.population_size, self._phase_times)
+
+            best_fitness_array = self.telemetry.column("best_fitness")
+            if generation >= self.patience and best_fitness_array[-1] - best_fitness_array[-1-self.patience] < self.tol:
+                stop_reason = "fitness_tolerance"
+                break
+            if diversity < self.diversity_tol:
+                stop_reason = "diversity_collapse"
+                break
+            if self.max_time is not None and self.telemetry.last['elapsed'] > self.max_time:
+                stop_reason = "time_budget"
+                break
+
+        self.global_best_chromosome = population[np.argmax(fitness)]
+        self.stop_reason = stop_reason
+        self.n_generations = generation
+
+    def _migrate(self, populations: list, fitnesses: list):
+        '''
+        Ring migration: the n_migrants best chromosomes of each island replace the worst ones of the next island.
+        '''
+        migrants = []
+        for population, fitness in zip(populations, fitnesses):
+            best = np.argsort(-fitness, kind='stable')[:self.n_migrants]
+            migrants.append((population[best].copy(), fitness[best].copy()))
+        for island in range(0, len(populations)):
+            population, fitness = populations[(island + 1) % len(populations)], fitnesses[(island + 1) % len(populations)]
+            worst = np.argsort(fitness, kind='stable')[:self.n_migrants]
+            population[worst], fitness[worst] = migrants[island]
+
+    def _fit_islands(self):
+        '''
+        Island model: n_islands differential evolution populations (population_size individuals each) evolve in
+        worker processes, each one with its own np.random.Generator spawned from seed. Every migration_interval
+        generations the islands exchange their best chromosomes (see _migrate). The same seed and n_islands give
+        bit-for-bit the same result whatever n_workers is. Early stopping (tol/patience, max_time) is checked at
+        every migration, which is also the only point where telemetry has population statistics.
+        '''
+        self._start_telemetry(self.N_iterations)
+        island_rngs = [np.random.default_rng(seed_sequence) for seed_sequence in np.random.SeedSequence(self.seed).spawn(self.n_islands)]
+        populations, fitnesses = [], []
+        for island_rng in island_rngs:
+            self.rng = island_rng
+            populations.append(self._generate_population())
+            fitnesses.append(self._population_fitness(populations[-1]))
+        self.rng = np.random.default_rng(self.seed)
+        self._record_generation(0, max(np.max(fitness) for fitness in fitnesses), np.concatenate(fitnesses), self._population_diversity(np.concatenate(populations)), self.n_islands*self.population_size)
+
+        stop_reason = "max_iterations"
+        generation = 0
+        n_workers = self.n_workers if self.n_workers is not None else min(self.n_islands, os.cpu_count())
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_island_worker, initargs=(self,)) as executor:
+            progress = tqdm(total=self.N_iterations, disable=not self.progress_bar)
+            while generation < self.N_iterations:
+                n_generations = min(self.migration_interval, self.N_iterations - generation)
+                results = list(executor.map(_evolve_island, populations, fitnesses, island_rngs, [n_generations]*self.n_islands))
+                populations = [result[0] for result in results]
+                fitnesses = [result[1] for result in results]
+                island_rngs = [result[2] for result in results]
+                history = np.max([result[3] for result in results], axis=0)
+
+                for epoch_generation in range(0, n_generations - 1):
+                    self._record_generation(generation + epoch_generation + 1, history[epoch_generation], evaluations=self.n_islands*self.population_size)
+                generation += n_generations
+                self._record_generation(generation, history[-1], np.concatenate(fitnesses), self._population_diversity(np.concatenate(populations)), self.n_islands*self.population_size)
+                progress.update(n_generations)
+                self._migrate(populations, fitnesses)
+
+                best_fitness_array = self.telemetry.column("best_fitness")
+                if generation >= self.patience and best_fitness_array[-1] - best_fitness_array[-1-self.patience] < self.tol:
+                    stop_reason = "fitness_tolerance"
+                    break
+                if self.max_time is not None and self.telemetry.last['elapsed'] > self.max_time:
+                    stop_reason = "time_budget"
+                    break
+            progress.close()
+
+        best_island = int(np.argmax([np.max(fitness) for fitness in fitnesses]))
+        self.global_best_chromosome = populations[best_island][np.argmax(fitnesses[best_island])]
+        self.stop_reason = stop_reason
+        self.n_generations = generation
+
+    def _fit_exact(self):
+        '''
+        Deterministic engine: solves the long-only max Sharpe problem exactly as a convex QP (see max_sharpe_qp).
+        fitness_array holds the Sharpe ratio of the iterates and n_generations the number of solver iterations.
+        '''
+        self._start_telemetry(0)
+        weights, sharpe_history, n_iterations, converged = solve_max_sharpe(self.expected_returns, self.covariance_matrix)
+        for iteration, sharpe in enumerate(sharpe_history):
+            self._record_generation(iteration, sharpe)
+        self.global_best_chromosome = weights
+        self.stop_reason = "converged" if converged else "max_iterations"
+        self.n_generations = n_iterations
 
 
     @property
@@ -0,0 +1,90 @@
+import numpy as np
+
+def _project(v: "np.array()", a: "np.array()") -> "np.array()":
+    '''
+    Euclidean projection of v onto {y >= 0, a.y = 1}.
+    The solution is y = max(0, v - tau*a), where g(tau) = a.y(tau) is piecewise linear and decreasing in tau.
+    Its breakpoints v_i/a_i are sorted once, so tau is found exactly in O(n log n).
+    '''
+    y = np.maximum(v, 0.0)
+    nonzero = a != 0
+    _v = v[nonzero]
+    _a = a[nonzero]
+
+    breakpoints = _v/_a
+    order = np.argsort(breakpoints)
+    breakpoints = breakpoints[order]
+    _v = _v[order]
+    _a = _a[order]
+
+    positive = _a > 0
+    av = _a*_v
+    aa = _a*_a
+    pos_av = np.where(positive, av, 0.0)
+    pos_aa = np.where(positive, aa, 0.0)
+    neg_av = np.where(positive, 0.0, av)
+    neg_aa = np.where(positive, 0.0, aa)
+
+    # Terms with a_i > 0 are active for tau < breakpoint_i, terms with a_i < 0 for tau > breakpoint_i.
+    suffix_pos_av = pos_av.sum() - np.cumsum(pos_av)
+    suffix_pos_aa = pos_aa.sum() - np.cumsum(pos_aa)
+    prefix_neg_av = np.cumsum(neg_av) - neg_av
+    prefix_neg_aa = np.cumsum(neg_aa) - neg_aa
+    g = (suffix_pos_av + prefix_neg_av) - breakpoints*(suffix_pos_aa + prefix_neg_aa)
+
+    below = np.nonzero(g <= 1.0)[0]
+    k = below[0] if below.shape[0] > 0 else breakpoints.shape[0]
+    # On (breakpoint_{k-1}, breakpoint_k) the active set is: positives with index >= k, negatives with index < k.
+    A = pos_av[k:].sum() + neg_av[:k].sum()
+    B = pos_aa[k:].sum() + neg_aa[:k].sum()
+    tau = (A - 1.0)/B
+
+    y[nonzero] = np.maximum(v[nonzero] - tau*a[nonzero], 0.0)
+    return y
+
+def _sharpe(weights: "np.array()", expected_returns: "np.array()", covariance_matrix: "np.array()") -> float:
+    return (expected_returns @ weights)/np.sqrt(weights @ covariance_matrix @ weights)
+
+def solve_max_sharpe(expected_returns: "np.array()", covariance_matrix: "np.array()", tol=1e-10, max_iter=10000) -> tuple:
+    '''
+    Exact long-only maximum Sharpe ratio portfolio (weights >= 0, sum of weights = 1).
+    With y = w/(mu.w), maximizing mu.w/sqrt(w'Sw) is the convex QP
+        min y'Sy  s.t.  mu.y = 1, y >= 0
+    solved here by accelerated projected gradient (FISTA with adaptive restart). Then w = y/sum(y).
+    Returns (weights, sharpe_history, n_iterations, converged).
+    '''
+    expected_returns = np.asarray(expected_returns, dtype=np.float64)
+    covariance_matrix = np.asarray(covariance_matrix, dtype=np.float64)
+    if not np.any(expected_returns > 0):
+        raise Exception("[solve_max_sharpe] At least one stock must have a positive expected return.")
+
+    step = 1.0/(2.0*np.linalg.eigvalsh(covariance_matrix)[-1])
+    y = _project(np.full(expected_returns.shape[0], 1.0), expected_returns)
+    z = y.copy()
+    momentum = 1.0
+    objective = y @ covariance_matrix @ y
+    sharpe_history = [_sharpe(y/np.sum(y), expected_returns, covariance_matrix)]
+    converged = False
+
+    for iteration in range(1, max_iter + 1):
+        y_next = _project(z - step*2.0*(covariance_matrix @ z), expected_returns)
+        objective_next = y_next @ covariance_matrix @ y_next
+
+        if objective_next > objective:
+            # Adaptive restart: drop the momentum and take a plain projected gradient step from y.
+            momentum = 1.0
+            y_next = _project(y - step*2.0*(covariance_matrix @ y), expected_returns)
+            objective_next = y_next @ covariance_matrix @ y_next
+
+        momentum_next = (1.0 + np.sqrt(1.0 + 4.0*momentum**2))/2.0
+        z = y_next + ((momentum - 1.0)/momentum_next)*(y_next - y)
+        change = np.linalg.norm(y_next - y)
+        y, objective, momentum = y_next, objective_next, momentum_next
+        sharpe_history.append(_sharpe(y/np.sum(y), expected_returns, covariance_matrix))
+
+        if change <= tol*(1.0 + np.linalg.norm(y)):
+            converged = True
+            break
+
+    weights = y/np.sum(y)
+    return weights, np.array(sharpe_history), iteration, converged
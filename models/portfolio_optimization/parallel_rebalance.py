@@ -0,0 +1,62 @@
+import pandas as pd
+import numpy as np
+import os
+import time
+import tempfile
+from datetime import date
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from models.portfolio_optimization.genetic_portfolio import GeneticPortfolio
+from models.portfolio_optimization.return_matrix_store import ReturnMatrixStore, DEFAULT_STORE_PATH
+from models.portfolio_optimization.covariance_provider import IncrementalCovariance
+
+RebalanceResult = namedtuple("RebalanceResult", ["job_index", "date", "seed", "best_portfolio", "fitness_array", "stop_reason", "n_generations", "elapsed"])
+
+# Return matrix store opened once per worker process. Its values are a read-only memory map, so the pages are
+# shared through the OS page cache instead of being pickled into each worker.
+_shared_returns = {}
+
+def _init_worker(store_path: str, incremental_covariance: bool):
+    _shared_returns['store'] = ReturnMatrixStore(store_path)
+    _shared_returns['covariance'] = IncrementalCovariance(_shared_returns['store']) if incremental_covariance else None
+
+def _run_job(job_index: int, end_date: date, stock_views: dict, start_date: date, seed: int, portfolio_kwargs: dict) -> RebalanceResult:
+    start_time = time.time()
+    if _shared_returns['covariance'] is not None:
+        genport = GeneticPortfolio(stock_views, start_date, end_date, covariance_provider=_shared_returns['covariance'], seed=seed, progress_bar=False, **portfolio_kwargs)
+    else:
+        return_matrix = _shared_returns['store'].get_returns(start_date, end_date, list(stock_views.keys()))
+        genport = GeneticPortfolio(stock_views, start_date, end_date, return_matrix=return_matrix, seed=seed, progress_bar=False, **portfolio_kwargs)
+    genport.fit()
+    return RebalanceResult(job_index, end_date, seed, genport.best_portfolio, genport.fitness_array, genport.stop_reason, genport.n_generations, time.time() - start_time)
+
+def job_seeds(n_jobs: int, seed=0) -> list:
+    '''
+    Deterministic seed of each job, derived only from the base seed and the job position.
+    '''
+    return [int(np.random.SeedSequence([seed, job_index]).generate_state(1)[0]) for job_index in range(n_jobs)]
+
+def optimize_rebalances(jobs: list, start_date: date, n_workers=None, seed=0, returns_file="data/matrix_returns.csv", store_path=DEFAULT_STORE_PATH, incremental_covariance=False, **portfolio_kwargs):
+    '''
+    Runs one GeneticPortfolio per (date, stock_views) job across a process pool, using date as end_date.
+    The workers memory-map the binary return matrix store in store_path, first brought up to date with returns_file
+    (see ReturnMatrixStore.open_synced); when it does not exist, returns_file is converted once into a temporary
+    store. With incremental_covariance, each worker keeps an IncrementalCovariance that is moved from one job
+    window to the next instead of recomputing the covariance from scratch. Results are yielded as the jobs finish,
+    so they come in completion order: use RebalanceResult.job_index to put them back in order.
+    Extra keyword arguments are forwarded to GeneticPortfolio (population_size, N_iterations, engine...).
+    '''
+    seeds = job_seeds(len(jobs), seed)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if ReturnMatrixStore.open_synced(returns_file, store_path) is None:
+            store_path = os.path.join(tmp_dir, "matrix_returns")
+            ReturnMatrixStore.from_csv(returns_file, store_path)
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(store_path, incremental_covariance)) as executor:
+            futures = []
+            for job_index, (job_date, stock_views) in enumerate(jobs):
+                end_date = pd.Timestamp(job_date).date()
+                futures.append(executor.submit(_run_job, job_index, end_date, stock_views, start_date, seeds[job_index], portfolio_kwargs))
+            for future in as_completed(futures):
+                yield future.result()
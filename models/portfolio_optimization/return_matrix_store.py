@@ -0,0 +1,132 @@
+import pandas as pd
+import numpy as np
+import json
+import logging
+import os
+from datetime import date
+from pathlib import Path
+
+DEFAULT_STORE_PATH = "data/matrix_returns"
+
+class ReturnMatrixStore():
+    '''
+    Binary, date-indexed copy of data/matrix_returns.csv:
+    -> values.bin: (dates x tickers) row-major matrix, opened as a read-only memory map;
+    -> dates.npy: sorted trading days (datetime64[D]);
+    -> meta.json: dtype, number of rows and ticker list (column order of values.bin).
+    Date ranges are found by binary search and tickers by a column map, so a query only touches the rows and
+    columns it returns.
+    '''
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = Path(path)
+        meta_file = self.path / "meta.json"
+        if not meta_file.exists():
+            raise Exception(f"[ReturnMatrixStore] Store not found in {self.path}. Build it first with ReturnMatrixStore.from_csv.")
+        with open(meta_file) as f:
+            meta = json.load(f)
+        self.dtype = np.dtype(meta['dtype'])
+        self.tickers = meta['tickers']
+        self.n_rows = meta['n_rows']
+        self.columns = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.dates = np.load(self.path / "dates.npy")[:self.n_rows]
+        if self.n_rows > 0:
+            self.values = np.memmap(self.path / "values.bin", dtype=self.dtype, mode='r', shape=(self.n_rows, len(self.tickers)))
+        else:
+            self.values = np.empty((0, len(self.tickers)), dtype=self.dtype)
+
+    @staticmethod
+    def exists(path=DEFAULT_STORE_PATH) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    @classmethod
+    def open_synced(cls, csv_file="data/matrix_returns.csv", path=DEFAULT_STORE_PATH) -> "ReturnMatrixStore":
+        '''
+        The store in path, brought up to date with csv_file when the CSV was modified after the store: the days
+        after the last stored one are appended, or the store is rebuilt when the CSV changed tickers or earlier
+        days. None when there is no store.
+        '''
+        if not cls.exists(path):
+            return None
+        store = cls(path)
+        if not os.path.exists(csv_file) or os.path.getmtime(csv_file) <= os.path.getmtime(store.path / "meta.json"):
+            return store
+
+        df_returns = cls._prepare_frame(pd.read_csv(csv_file))
+        tickers = [column for column in df_returns.columns if column != 'date']
+        old_dates = df_returns['date'].values[:store.n_rows]
+        if set(tickers) == set(store.tickers) and old_dates.shape[0] == store.n_rows and np.array_equal(old_dates, store.dates):
+            logging.info(f"[ReturnMatrixStore] {csv_file} is newer than {store.path}: appending {df_returns.shape[0] - store.n_rows} days.")
+            return store.append(df_returns.iloc[store.n_rows:])
+        logging.warning(f"[ReturnMatrixStore] {csv_file} changed tickers or past days: rebuilding {store.path}.")
+        return cls.from_frame(df_returns, path, store.dtype)
+
+    @staticmethod
+    def _prepare_frame(df_returns: "pd.DataFrame()") -> "pd.DataFrame()":
+        df_returns = df_returns.copy()
+        df_returns['date'] = pd.to_datetime(df_returns['date']).values.astype('datetime64[D]')
+        df_returns = df_returns.fillna(0) #gambiarra
+        df_returns = df_returns.sort_values('date', kind='mergesort')
+        return df_returns
+
+    @classmethod
+    def from_csv(cls, csv_file="data/matrix_returns.csv", path=DEFAULT_STORE_PATH, dtype="float64") -> "ReturnMatrixStore":
+        df_returns = pd.read_csv(csv_file)
+        return cls.from_frame(df_returns, path, dtype)
+
+    @classmethod
+    def from_frame(cls, df_returns: "pd.DataFrame()", path=DEFAULT_STORE_PATH, dtype="float64") -> "ReturnMatrixStore":
+        '''
+        Writes a new store from a DataFrame laid out as matrix_returns.csv (a 'date' column plus one column per ticker).
+        '''
+        df_returns = cls._prepare_frame(df_returns)
+        tickers = [column for column in df_returns.columns if column != 'date']
+        p = Path(path)
+        p.mkdir(parents=True, exist_ok=True)
+        df_returns[tickers].to_numpy(dtype=dtype).tofile(p / "values.bin")
+        np.save(p / "dates.npy", df_returns['date'].values.astype('datetime64[D]'))
+        cls._write_meta(p, dtype, tickers, df_returns.shape[0])
+        return cls(path)
+
+    @staticmethod
+    def _write_meta(path: Path, dtype: str, tickers: list, n_rows: int):
+        tmp_file = path / "meta.json.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"dtype": str(np.dtype(dtype)), "tickers": tickers, "n_rows": int(n_rows)}, f)
+        tmp_file.replace(path / "meta.json")
+
+    def append(self, df_new: "pd.DataFrame()") -> "ReturnMatrixStore":
+        '''
+        Appends new trading days (same layout as matrix_returns.csv) at the end of the store. Dates must be later
+        than the last stored day; missing tickers are filled with 0 and unknown tickers are refused.
+        Returns a fresh store instance that sees the new rows.
+        '''
+        df_new = self._prepare_frame(df_new)
+        new_tickers = [column for column in df_new.columns if column != 'date' and column not in self.columns]
+        if len(new_tickers) > 0:
+            raise Exception(f"[ReturnMatrixStore] Tickers {new_tickers} are not in the store. Rebuild it with ReturnMatrixStore.from_csv.")
+        if self.n_rows > 0 and df_new.shape[0] > 0 and df_new['date'].values[0] <= self.dates[-1]:
+            raise Exception(f"[ReturnMatrixStore] Only dates after {self.dates[-1]} can be appended.")
+
+        df_new = df_new.reindex(columns=['date'] + self.tickers, fill_value=0.0)
+        with open(self.path / "values.bin", "r+b" if (self.path / "values.bin").exists() else "wb") as f:
+            # Rows left after n_rows by an append interrupted before its meta.json was written are dropped.
+            f.truncate(self.n_rows*len(self.tickers)*self.dtype.itemsize)
+            f.seek(0, os.SEEK_END)
+            df_new[self.tickers].to_numpy(dtype=self.dtype).tofile(f)
+        np.save(self.path / "dates.npy", np.concatenate([self.dates, df_new['date'].values.astype('datetime64[D]')]))
+        self._write_meta(self.path, self.dtype, self.tickers, self.n_rows + df_new.shape[0])
+        return ReturnMatrixStore(self.path)
+
+    def date_range(self, start_date: date, end_date: date) -> slice:
+        first = np.searchsorted(self.dates, np.datetime64(start_date, 'D'), side='left')
+        last = np.searchsorted(self.dates, np.datetime64(end_date, 'D'), side='right')
+        return slice(first, last)
+
+    def get_returns(self, start_date: date, end_date: date, tickers: list) -> "pd.DataFrame()":
+        rows = self.date_range(start_date, end_date)
+        columns = [self.columns[ticker] for ticker in tickers]
+        return pd.DataFrame(np.asarray(self.values[rows][:, columns]), index=self.dates[rows], columns=tickers)
+
+    @property
+    def shape(self) -> tuple:
+        return (self.n_rows, len(self.tickers))
@@ -0,0 +1,70 @@
+import pandas as pd
+import numpy as np
+import plotly.graph_objects as go
+
+TELEMETRY_FIELDS = [
+    "generation",
+    "elapsed",
+    "best_fitness",
+    "mean_fitness",
+    "std_fitness",
+    "diversity",
+    "evaluations",
+    "evaluations_per_sec",
+    "variation_time",
+    "fitness_time",
+    "selection_time",
+]
+
+class FitTelemetry():
+    '''
+    Per-generation history of a GeneticPortfolio.fit run, kept in a buffer preallocated for max_generations
+    generations (plus the initial population, recorded as generation 0). Fields not measured by an engine are NaN.
+    '''
+    def __init__(self, max_generations: int):
+        self.history = np.full((max_generations + 1, len(TELEMETRY_FIELDS)), np.nan)
+        self.n_records = 0
+        self._columns = {field: i for i, field in enumerate(TELEMETRY_FIELDS)}
+
+    def record(self, **values) -> dict:
+        if self.n_records == self.history.shape[0]:
+            self.history = np.concatenate([self.history, np.full(self.history.shape, np.nan)])
+        row = self.history[self.n_records]
+        for field, value in values.items():
+            row[self._columns[field]] = value
+        self.n_records += 1
+        return self._as_record(row)
+
+    @staticmethod
+    def _as_record(row: "np.array()") -> dict:
+        record = dict(zip(TELEMETRY_FIELDS, row.tolist()))
+        record['generation'] = int(record['generation'])
+        return record
+
+    def column(self, field: str) -> "np.array()":
+        return self.history[:self.n_records, self._columns[field]]
+
+    @property
+    def last(self) -> dict:
+        return self._as_record(self.history[self.n_records - 1])
+
+    def to_frame(self) -> "pd.DataFrame()":
+        df = pd.DataFrame(self.history[:self.n_records], columns=TELEMETRY_FIELDS)
+        df['generation'] = df['generation'].astype(int)
+        return df.set_index('generation')
+
+class LivePlotCallback():
+    '''
+    Plotly FigureWidget of the best fitness along generations, updated by GeneticPortfolio.fit every
+    callback_interval generations. This is what live_plot=True plugs into fit.
+    '''
+    def __init__(self):
+        self.figure = go.FigureWidget()
+        self.figure.layout.title = 'Fitness Evolution along generations'
+        self.figure.layout.xaxis.title = "Generation"
+        self.figure.layout.yaxis.title = "Fitness (Sharpe Ratio)"
+
+    def __call__(self, genport, record: dict):
+        if len(self.figure.data) == 0:
+            self.figure.add_scatter()
+        self.figure.data[0].y = genport.telemetry.column("best_fitness")